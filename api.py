@@ -2,17 +2,53 @@ import os
 import uuid
 import asyncio
 import sqlite3
-from flask import Flask, request, jsonify, send_from_directory
+import queue
+import sys
+import inspect
+import tempfile
+import contextvars
+from functools import partial, lru_cache
+from contextlib import contextmanager
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
-from telethon import TelegramClient
-from telethon.errors import SessionPasswordNeededError, AuthRestartError
+from werkzeug.formparser import FormDataParser
+from telethon import TelegramClient, events, utils
+from telethon.errors import (
+    SessionPasswordNeededError, AuthRestartError, FloodWaitError, SlowModeWaitError,
+    FileReferenceExpiredError, FileReferenceInvalidError, MediaEmptyError, FilePartMissingError
+)
 from telethon.sessions import StringSession
-from telethon.tl.functions.messages import GetFullChatRequest
+from telethon.tl.functions.messages import (
+    GetFullChatRequest, SendMessageRequest, SendMediaRequest, SendMultiMediaRequest, ForwardMessagesRequest
+)
 from telethon.tl.functions.channels import GetFullChannelRequest
-from threading import Thread
+from telethon.tl.types import (
+    InputMessageEntityMentionName, InputUser, Chat, Channel, PeerChat, PeerChannel, UpdateChat, UpdateChannel
+)
+from threading import Thread, Lock, Event
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from collections import deque, OrderedDict
 import base64
+import json
+import heapq
+import hashlib
+import itertools
+import bisect
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import imaging
+except ImportError:  # Pillow não instalado: as imagens são enviadas como chegaram
+    imaging = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem a trava de processo único da API
+    fcntl = None
 
 
 # Inicialização do Flask
@@ -25,30 +61,455 @@ authenticated = False
 authenticated_phone = None
 api_id = None
 api_hash = None
-asyncio_loop = None
-
-tasks = {}  # {task_id: {"group_name": ..., "time": ..., "image": ..., "text": ..., "status": ...}}
-groups_cache = []
+asyncio_loop = None  # criado por lifecycle.start (ou é o loop do servidor ASGI)
+
+groups_loading = False
+groups_load_error = None
+GROUP_LOAD_RATE = 5  # requisições GetFull* por segundo (links de convite)
+INVITE_LINK_TTL = 24 * 3600  # os eventos invalidam antes; o TTL cobre o que não gera update
+MEMBER_CACHE_TTL = 6 * 3600
+MESSAGE_MAX_LENGTH = 4096  # em unidades UTF-16, como o Telegram conta
+MENTIONS_PER_MESSAGE = 50
+MENTION_SEND_INTERVAL = 1.5  # segundos entre mensagens de marcação
+BROADCAST_CONCURRENCY = 5
+BROADCAST_MAX_ATTEMPTS = 3
+BROADCAST_BACKOFF = 2  # segundos, dobra a cada nova tentativa
+ACCOUNT_SEND_CONCURRENCY = 3  # envios simultâneos por conta
+RPC_GLOBAL_RATE = 20  # requisições por segundo por conta
+CHAT_SEND_RATE = 20 / 60  # mensagens por segundo em um mesmo chat
+CHAT_SEND_BURST = 3
+RATE_MIN_FACTOR = 0.1  # após FloodWaits a taxa não cai abaixo de 10% do teto
+RATE_RECOVERY = 0.02  # cada sucesso devolve 2% do teto à taxa
+FLOOD_RETRY_MAX = 60  # leituras com FloodWait até este valor esperam e repetem
+CHAT_BUCKETS_MAX = 1024
 upload_dir = "uploads"
-os.makedirs(upload_dir, exist_ok=True)
+MAX_IMAGE_BYTES = 10 * 1024 * 1024  # limite do Telegram para fotos
+MAX_FORM_MEMORY = 1024 * 1024  # campos de texto do multipart (JSON das tarefas)
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", 2))  # processos de pré-processamento
+VARIANT_WAIT = 10  # segundos que /uploads espera uma variante ainda não gerada
+DELIVERY_BATCH = 500  # linhas do log de entregas por transação
+DELIVERY_FLUSH_INTERVAL = 1.0
+DELIVERY_RETENTION_DAYS = int(os.environ.get("DELIVERY_RETENTION_DAYS", 30))  # depois disso, só o resumo diário
+DELIVERY_ROLLUP_DAYS = int(os.environ.get("DELIVERY_ROLLUP_DAYS", 365))
+DELIVERY_COMPACT_INTERVAL = 3600
+ALLOWED_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
 db_file = "data.db"
+DB_POOL_SIZE = 4
+EXECUTION_MODE = os.environ.get("EXECUTION_MODE", "inline")  # "inline" ou "queue"
+JOB_LEASE_SECONDS = 120
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY = 30  # segundos, multiplicado pelo número de tentativas
+JOB_RETENTION = 7 * 24 * 3600
+MISFIRE_GRACE_SECONDS = int(os.environ.get("MISFIRE_GRACE_SECONDS", 300))
+CATCH_UP_POLICY = os.environ.get("CATCH_UP_POLICY", "latest")  # "latest" ou "all"
+SCHEDULER_TIMEZONE = os.environ.get("SCHEDULER_TIMEZONE")  # padrão: fuso do servidor
+PRESTAGE_LEAD_SECONDS = int(os.environ.get("PRESTAGE_LEAD_SECONDS", 120))  # 0 desliga a pré-preparação
+DISPATCH_SPREAD_SECONDS = int(os.environ.get("DISPATCH_SPREAD_SECONDS", 0))  # janela padrão de espalhamento; 0 desliga
+SPREAD_MAX_SECONDS = 3600
+TRACE_FILE = os.environ.get("TRACE_FILE")  # spans dos envios em JSON Lines (opcional)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+FLOOD_WAIT_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 3600)
+
+# Métricas
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, values, (), value) for values, value in self._values.items()]
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values = {}  # {label_values: [contagem por bucket..., +Inf, soma]}
+        self._lock = Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[bisect.bisect_left(self.buckets, value)] += 1
+            state[-1] += value
+
+    def totals(self, *label_values):
+        # (quantidade, soma) das observações de uma série
+        with self._lock:
+            state = self._values.get(label_values)
+        return (sum(state[:-1]), state[-1]) if state else (0, 0.0)
+
+    def samples(self):
+        with self._lock:
+            items = [(values, list(state)) for values, state in self._values.items()]
+        rows = []
+        for values, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state):
+                cumulative += count
+                rows.append((self.name + "_bucket", values, (("le", format_value(bound)),), cumulative))
+            rows.append((self.name + "_sum", values, (), state[-1]))
+            rows.append((self.name + "_count", values, (), cumulative))
+        return rows
+
+class Gauge:
+    # Valor lido na hora da coleta: collect() devolve [(valores dos labels, valor)]
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels, collect):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.collect = collect
+
+    def samples(self):
+        return [(self.name, tuple(values), (), value) for values, value in self.collect()]
+
+class MetricsRegistry:
+    # Registro próprio no formato texto do Prometheus, sem dependências
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def gauge(self, name, help_text, labels=(), collect=None):
+        return self._register(Gauge(name, help_text, labels, collect))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print(f"Erro ao coletar a métrica {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, values, extra, value in samples:
+                lines.append(f"{name}{format_labels(metric.labels, values, extra)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+http_requests = metrics.counter("http_requests_total", "Requisições HTTP por rota e status", ("method", "route", "status"))
+http_latency = metrics.histogram("http_request_duration_seconds", "Latência das rotas HTTP", ("method", "route"))
+rpc_calls = metrics.counter("telegram_rpc_total", "Chamadas RPC ao Telegram por método e resultado", ("method", "outcome"))
+rpc_latency = metrics.histogram("telegram_rpc_duration_seconds", "Latência das chamadas RPC ao Telegram", ("method",))
+flood_waits = metrics.counter("telegram_flood_wait_total", "FloodWaits recebidos do Telegram", ("method",))
+flood_wait_seconds = metrics.histogram(
+    "telegram_flood_wait_seconds", "Espera pedida pelo Telegram em cada FloodWait", ("method",), FLOOD_WAIT_BUCKETS
+)
+scheduler_lag = metrics.histogram("scheduler_lag_seconds", "Atraso entre o horário agendado e o disparo")
+scheduler_fires = metrics.counter("scheduler_fires_total", "Disparos do agendador por resultado", ("result",))
+prestages = metrics.counter("send_prestage_total", "Pré-preparações de envio por resultado", ("result",))
+upload_bytes = metrics.counter("upload_bytes_total", "Bytes de imagens recebidos", ("source",))
+db_time = metrics.histogram("db_connection_seconds", "Tempo com uma conexão do banco em uso")
+cache_requests = metrics.counter("cache_requests_total", "Consultas aos caches (diálogos, membros e mídia)", ("cache", "result"))
+
+# Rastreamento
+current_span = contextvars.ContextVar("current_span", default=None)
+
+class Tracer:
+    # Spans dos envios (escolha da conta, upload, RPCs) gravados em JSON Lines
+    # no TRACE_FILE; os spans de um mesmo envio compartilham o trace_id
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = Lock()
+
+    @contextmanager
+    def span(self, name, child=False, **attrs):
+        # child=True só grava o span dentro de um trace já aberto (ex.: RPCs)
+        parent = current_span.get()
+        if not self.path or (child and parent is None):
+            yield
+            return
+        trace_id = parent[0] if parent else uuid.uuid4().hex
+        span_id = uuid.uuid4().hex[:16]
+        token = current_span.set((trace_id, span_id))
+        start = time.time()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            current_span.reset(token)
+            self._write({
+                "trace_id": trace_id,
+                "span_id": span_id,
+                "parent_id": parent[1] if parent else None,
+                "name": name,
+                "start": start,
+                "duration": time.time() - start,
+                "error": error,
+                **attrs
+            })
+
+    def _write(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", buffering=1)
+            self._file.write(line + "\n")
+
+tracer = Tracer(TRACE_FILE)
+
+# Limitador de Requisições
+class TokenBucket:
+    # Limitador token bucket; pause() suspende todas as aquisições (FloodWait).
+    # Com min_rate, a taxa é adaptativa (AIMD): slow_down() a divide por dois e
+    # speed_up() a recupera aos poucos até o teto configurado.
+    def __init__(self, rate, capacity=None, min_rate=None):
+        self.rate = rate
+        self.max_rate = rate
+        self.min_rate = min_rate or rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def paused_for(self):
+        return max(0, self._paused_until - time.monotonic())
+
+    def slow_down(self):
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_RECOVERY)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+SEND_REQUESTS = (SendMessageRequest, SendMediaRequest, SendMultiMediaRequest, ForwardMessagesRequest)
+
+class RpcLimiter:
+    # Fica na frente de todas as RPCs de uma conta: um bucket global e, para
+    # envios, um bucket por chat. Um FloodWait em envio pausa a conta pelo
+    # tempo pedido; em leitura, só o método que o recebeu. Os dois reduzem as
+    # taxas e os sucessos as recuperam.
+    def __init__(self):
+        self.global_bucket = TokenBucket(RPC_GLOBAL_RATE, min_rate=RPC_GLOBAL_RATE * RATE_MIN_FACTOR)
+        self._chats = OrderedDict()  # {peer_id: TokenBucket}, os menos usados saem primeiro
+        self._methods = {}  # {método de leitura: fim do FloodWait em time.monotonic()}
+
+    @staticmethod
+    def chat_key(request):
+        if not isinstance(request, SEND_REQUESTS):
+            return None
+        try:
+            return utils.get_peer_id(getattr(request, "peer", None) or request.to_peer)
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+    def _chat_bucket(self, key):
+        bucket = self._chats.get(key)
+        if bucket is None:
+            bucket = self._chats[key] = TokenBucket(
+                CHAT_SEND_RATE, CHAT_SEND_BURST, min_rate=CHAT_SEND_RATE * RATE_MIN_FACTOR
+            )
+            if len(self._chats) > CHAT_BUCKETS_MAX:
+                self._chats.popitem(last=False)
+        self._chats.move_to_end(key)
+        return bucket
+
+    async def acquire(self, chat, method=None):
+        while method in self._methods:
+            remaining = self._methods[method] - time.monotonic()
+            if remaining <= 0:
+                del self._methods[method]
+                break
+            await asyncio.sleep(remaining)
+        if chat is not None:
+            await self._chat_bucket(chat).acquire()
+        await self.global_bucket.acquire()
+
+    def on_success(self, chat):
+        self.global_bucket.speed_up()
+        if chat is not None:
+            self._chat_bucket(chat).speed_up()
+
+    def on_flood(self, chat, seconds):
+        self.global_bucket.pause(seconds)
+        self.global_bucket.slow_down()
+        if chat is not None:
+            self._chat_bucket(chat).slow_down()
+
+    def on_read_flood(self, method, seconds):
+        # O FloodWait de uma leitura vale para aquele método; os envios seguem
+        self._methods[method] = max(self._methods.get(method, 0), time.monotonic() + seconds)
+        self.global_bucket.slow_down()
+
+    def send_paused_for(self):
+        # Segundos até a conta voltar a enviar (0 se não está pausada)
+        return self.global_bucket.paused_for()
+
+    def on_slow_mode(self, chat, seconds):
+        # Slow mode é uma regra do chat, não da conta
+        if chat is not None:
+            bucket = self._chat_bucket(chat)
+            bucket.pause(seconds)
+            bucket.slow_down()
+
+class InstrumentedTelegramClient(TelegramClient):
+    # Toda chamada RPC passa por _call: o limitador decide quando ela sai e
+    # contamos método, latência e FloodWaits. O Telethon não dorme sozinho em
+    # FloodWaits (flood_sleep_threshold=0): envios recebem o erro para que o
+    # pipeline troque de conta, leituras esperam e repetem.
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("flood_sleep_threshold", 0)
+        super().__init__(*args, **kwargs)
+        self.limiter = RpcLimiter()
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        method = type(request).__name__ if not isinstance(request, list) else "batch"
+        chat = self.limiter.chat_key(request)
+        is_send = isinstance(request, SEND_REQUESTS)
+        while True:
+            await self.limiter.acquire(chat, None if is_send else method)
+            start = time.perf_counter()
+            outcome = "ok"
+            try:
+                with tracer.span("rpc", child=True, method=method):
+                    result = await super()._call(sender, request, ordered, flood_sleep_threshold)
+            except FloodWaitError as e:
+                outcome = "flood_wait"
+                flood_waits.inc(method)
+                flood_wait_seconds.observe(e.seconds, method)
+                if is_send:
+                    self.limiter.on_flood(chat, e.seconds)
+                    raise
+                self.limiter.on_read_flood(method, e.seconds)
+                if e.seconds > FLOOD_RETRY_MAX:
+                    raise
+                continue
+            except SlowModeWaitError as e:
+                outcome = "slow_mode"
+                self.limiter.on_slow_mode(chat, e.seconds)
+                raise
+            except Exception:
+                outcome = "error"
+                raise
+            finally:
+                rpc_calls.inc(method, outcome)
+                rpc_latency.observe(time.perf_counter() - start, method)
+            self.limiter.on_success(chat)
+            return result
+
+def create_client(session, api_id, api_hash):
+    # Ponto único de criação dos clientes (bench.py troca por um backend falso)
+    return InstrumentedTelegramClient(session, int(api_id), api_hash)
 
 # Banco de Dados
-def init_db():
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    
-    # Primeiro, vamos fazer backup da tabela existente
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS tasks_backup AS
-        SELECT * FROM tasks
-    ''')
-    
-    # Dropar a tabela antiga
-    c.execute('DROP TABLE IF EXISTS tasks')
-    
-    # Criar a nova tabela com a estrutura correta
-    c.execute('''
+class ConnectionPool:
+    # Pool de conexões SQLite compartilhado entre as threads do Flask e o loop
+    # assíncrono. Cada conexão usa WAL e mantém seu cache de statements
+    # preparados, por isso as consultas ficam em constantes reutilizadas.
+    def __init__(self, path, size=DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return self._connect()
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        start = time.perf_counter()
+        try:
+            yield conn
+        finally:
+            db_time.observe(time.perf_counter() - start)
+            self._idle.put(conn)
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as conn:
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+db_pool = ConnectionPool(db_file)
+
+# Migrações: cada função leva o schema da versão N para N+1 (PRAGMA user_version).
+# Só as pendentes são aplicadas, cada uma em sua própria transação.
+def migration_create_tables(conn):
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    # Recupera o backup deixado por um init_db antigo interrompido no meio da cópia
+    if "tasks_backup" in tables and "tasks" not in tables:
+        conn.execute("ALTER TABLE tasks_backup RENAME TO tasks")
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS tasks (
             id TEXT PRIMARY KEY,
             group_name TEXT,
@@ -59,17 +520,7 @@ def init_db():
             tag_members INTEGER DEFAULT 0
         )
     ''')
-    
-    # Restaurar dados do backup se existir
-    try:
-        c.execute('INSERT INTO tasks SELECT * FROM tasks_backup')
-    except:
-        pass
-    
-    # Remover tabela de backup
-    c.execute('DROP TABLE IF EXISTS tasks_backup')
-    
-    c.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS login (
             id INTEGER PRIMARY KEY,
             api_id TEXT,
@@ -78,16 +529,1387 @@ def init_db():
             session TEXT
         )
     ''')
-    conn.commit()
-    conn.close()
 
-init_db()
+def migration_tasks_tag_members(conn):
+    # Bancos criados antes de tag_members existir não têm a coluna
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(tasks)")}
+    if "tag_members" not in columns:
+        conn.execute("ALTER TABLE tasks ADD COLUMN tag_members INTEGER DEFAULT 0")
+
+def migration_tasks_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_time ON tasks (time)")
+
+def migration_broadcast_targets(conn):
+    conn.execute("ALTER TABLE tasks ADD COLUMN kind TEXT DEFAULT 'single'")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS task_targets (
+            task_id TEXT NOT NULL,
+            group_name TEXT NOT NULL,
+            status TEXT,
+            attempts INTEGER DEFAULT 0,
+            message_id INTEGER,
+            error TEXT,
+            updated_at REAL,
+            PRIMARY KEY (task_id, group_name)
+        )
+    ''')
+
+def migration_group_members(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS group_members (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            access_hash INTEGER,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS group_member_sync (
+            chat_id INTEGER PRIMARY KEY,
+            refreshed_at REAL
+        )
+    ''')
+
+def migration_member_cache_per_account(conn):
+    # O cache de membros passa a ser por conta (access_hash depende da conta);
+    # é só cache, então as tabelas são recriadas vazias
+    conn.execute("DROP TABLE IF EXISTS group_members")
+    conn.execute("DROP TABLE IF EXISTS group_member_sync")
+    conn.execute('''
+        CREATE TABLE group_members (
+            account TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            access_hash INTEGER,
+            PRIMARY KEY (account, chat_id, user_id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE group_member_sync (
+            account TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            refreshed_at REAL,
+            PRIMARY KEY (account, chat_id)
+        )
+    ''')
+
+def migration_jobs(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id TEXT NOT NULL,
+            due_at REAL NOT NULL,
+            available_at REAL NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_expires_at REAL,
+            last_error TEXT,
+            created_at REAL,
+            updated_at REAL,
+            UNIQUE (task_id, due_at)
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs (status, available_at)")
+
+def migration_task_schedule(conn):
+    conn.execute("ALTER TABLE tasks ADD COLUMN timezone TEXT")
+    conn.execute("ALTER TABLE tasks ADD COLUMN last_fired_at REAL")
+    conn.execute("ALTER TABLE tasks ADD COLUMN next_fire_at REAL")
+
+def migration_task_dispatch(conn):
+    # spread_seconds NULL = janela global (DISPATCH_SPREAD_SECONDS); os offsets
+    # são os do último disparo, em segundos depois do horário agendado
+    conn.execute("ALTER TABLE tasks ADD COLUMN spread_seconds INTEGER")
+    conn.execute("ALTER TABLE tasks ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE tasks ADD COLUMN planned_offset REAL")
+    conn.execute("ALTER TABLE tasks ADD COLUMN actual_offset REAL")
+
+def migration_task_listing_indexes(conn):
+    # Listagem filtrada de /tasks: status + horário, grupo e grupos dos envios em massa
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status_time ON tasks (status, time, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_group ON tasks (group_name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_task_targets_group ON task_targets (group_name)")
+
+def migration_task_next_fire_index(conn):
+    # /tasks ordena e filtra pelo próximo disparo
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_next_fire ON tasks (next_fire_at, id)")
+
+def migration_task_time_padding(conn):
+    # Horários diários gravados como "H:MM" passam a "HH:MM" (filtro por horário)
+    conn.execute("UPDATE tasks SET time = '0' || time WHERE time GLOB '[0-9]:[0-5][0-9]'")
+
+def migration_deliveries(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS deliveries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id TEXT,
+            group_name TEXT NOT NULL,
+            chat_id INTEGER,
+            account TEXT,
+            status TEXT NOT NULL,
+            message_id INTEGER,
+            attempts INTEGER NOT NULL,
+            latency REAL,
+            error TEXT,
+            created_at REAL NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_deliveries_task ON deliveries (task_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_deliveries_group ON deliveries (group_name, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_deliveries_created ON deliveries (created_at)")
+    # Resumo diário das entregas que já saíram da retenção
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS delivery_daily (
+            day TEXT NOT NULL,
+            task_id TEXT NOT NULL,
+            group_name TEXT NOT NULL,
+            sent INTEGER NOT NULL,
+            failed INTEGER NOT NULL,
+            latency_total REAL NOT NULL,
+            PRIMARY KEY (day, task_id, group_name)
+        )
+    ''')
+
+def migration_chat_groups(conn):
+    # Lista de grupos de cada conta; link_fetched_at NULL = link ainda não buscado
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_groups (
+            account TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            link TEXT,
+            link_fetched_at REAL,
+            PRIMARY KEY (account, chat_id)
+        )
+    ''')
+
+MIGRATIONS = [
+    migration_create_tables,
+    migration_tasks_tag_members,
+    migration_tasks_indexes,
+    migration_broadcast_targets,
+    migration_group_members,
+    migration_member_cache_per_account,
+    migration_jobs,
+    migration_task_schedule,
+    migration_task_listing_indexes,
+    migration_deliveries,
+    migration_chat_groups,
+    migration_task_dispatch,
+    migration_task_next_fire_index,
+    migration_task_time_padding,
+]
+
+def init_db():
+    with db_pool.connection() as conn:
+        while True:
+            # BEGIN IMMEDIATE serializa processos que iniciam ao mesmo tempo
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    conn.rollback()
+                    return
+                MIGRATIONS[version](conn)
+                conn.execute(f"PRAGMA user_version = {version + 1}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+# Repositório de Tarefas
+TASK_SELECT = """
+    SELECT id, group_name, time, text, image, status, tag_members, kind, timezone, last_fired_at, next_fire_at,
+           spread_seconds, priority, planned_offset, actual_offset
+    FROM tasks
+"""
+TASK_INSERT = """
+    INSERT INTO tasks (
+        id, group_name, time, text, image, status, tag_members, kind, timezone, spread_seconds, priority, next_fire_at
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+TASK_UPDATE = """
+    UPDATE tasks
+    SET group_name = ?, time = ?, text = ?, image = ?, status = ?, tag_members = ?, kind = ?, timezone = ?,
+        spread_seconds = ?, priority = ?
+    WHERE id = ?
+"""
+TASK_FIRE_UPDATE = """
+    UPDATE tasks
+    SET last_fired_at = COALESCE(?, last_fired_at), next_fire_at = ?,
+        planned_offset = COALESCE(?, planned_offset), actual_offset = COALESCE(?, actual_offset)
+    WHERE id = ?
+"""
+TASK_NEXT_FIRE_UPDATE = "UPDATE tasks SET next_fire_at = ? WHERE id = ?"
+TASK_GROUP_FILTER = "(group_name = ? OR id IN (SELECT task_id FROM task_targets WHERE group_name = ?))"
+# Pelo próximo disparo (o campo time pode ser uma expressão cron, que não
+# ordena como texto); tarefas paradas, sem próximo disparo, vão para o fim
+TASK_ORDER = " ORDER BY next_fire_at IS NULL, next_fire_at, time, id LIMIT ? OFFSET ?"
+TASK_DAILY_TIME = "time GLOB '[0-2][0-9]:[0-5][0-9]'"
+SQL_CHUNK = 500  # ids por consulta IN (...), abaixo do limite de variáveis do SQLite
+TASK_DELETE = "DELETE FROM tasks WHERE id = ?"
+TARGET_SELECT = "SELECT task_id, group_name FROM task_targets ORDER BY rowid"
+TARGET_SELECT_TASK = "SELECT task_id, group_name FROM task_targets WHERE task_id = ? ORDER BY rowid"
+TARGET_INSERT = "INSERT INTO task_targets (task_id, group_name, status) VALUES (?, ?, 'Pendente')"
+TARGET_DELETE = "DELETE FROM task_targets WHERE task_id = ?"
+TARGET_RESET = """
+    UPDATE task_targets
+    SET status = 'Pendente', attempts = 0, message_id = NULL, error = NULL, updated_at = ?
+    WHERE task_id = ?
+"""
+TARGET_UPDATE = """
+    UPDATE task_targets
+    SET status = ?, attempts = ?, message_id = ?, error = ?, updated_at = ?
+    WHERE task_id = ? AND group_name = ?
+"""
+TARGET_PROGRESS = "SELECT task_id, status, COUNT(*) FROM task_targets GROUP BY task_id, status"
+TARGET_PROGRESS_IN = "SELECT task_id, status, COUNT(*) FROM task_targets WHERE task_id IN ({}) GROUP BY task_id, status"
+TARGET_SELECT_IN = "SELECT task_id, group_name FROM task_targets WHERE task_id IN ({}) ORDER BY rowid"
+TARGET_STATUS = {"Pendente": "pending", "Enviado": "sent", "Falhou": "failed"}
+
+def sql_chunks(values):
+    values = list(values)
+    for start in range(0, len(values), SQL_CHUNK):
+        chunk = values[start:start + SQL_CHUNK]
+        yield chunk, ",".join("?" * len(chunk))
+
+class TaskRepository:
+    # Fonte da verdade das tarefas: toda escrita vai primeiro ao banco (em uma
+    # única transação por chamada) e depois ao cache em memória, que serve as
+    # leituras. get/all devolvem cópias para que o cache só mude por aqui.
+    def __init__(self, pool):
+        self.pool = pool
+        self._cache = {}  # {task_id: {"group_name": ..., "time": ..., "image": ..., "text": ..., "status": ...}}
+        self._lock = Lock()
+
+    @staticmethod
+    def _from_row(row):
+        (task_id, group_name, time_str, text, image, status, tag_members, kind,
+         timezone, last_fired_at, next_fire_at, spread_seconds, priority, planned_offset, actual_offset) = row
+        return task_id, {
+            "group_name": group_name,
+            "time": time_str,
+            "text": text,
+            "image": image,
+            "status": status,
+            "tag_members": bool(tag_members),
+            "kind": kind or "single",
+            "timezone": timezone,
+            "last_fired_at": last_fired_at,
+            "next_fire_at": next_fire_at,
+            "spread_seconds": spread_seconds,
+            "priority": priority or 0,
+            "planned_offset": planned_offset,
+            "actual_offset": actual_offset
+        }
+
+    @staticmethod
+    def _to_row(task_id, task):
+        return (task["group_name"], task["time"], task["text"], task.get("image") or "",
+                task["status"], 1 if task.get("tag_members") else 0, task.get("kind", "single"),
+                task.get("timezone"), task.get("spread_seconds"), task.get("priority") or 0, task_id)
+
+    @staticmethod
+    def _copy(task):
+        task = dict(task)
+        if "group_names" in task:
+            task["group_names"] = list(task["group_names"])
+        return task
+
+    def load(self):
+        with self.pool.connection() as conn:
+            rows = conn.execute(TASK_SELECT).fetchall()
+            targets = conn.execute(TARGET_SELECT).fetchall()
+        cache = dict(self._from_row(row) for row in rows)
+        for task_id, group_name in targets:
+            if task_id in cache:
+                cache[task_id].setdefault("group_names", []).append(group_name)
+        with self._lock:
+            self._cache = cache
+
+    def get(self, task_id):
+        task = self._cache.get(task_id)
+        return self._copy(task) if task is not None else None
+
+    def all(self):
+        return [(task_id, self._copy(task)) for task_id, task in list(self._cache.items())]
+
+    def add_many(self, new_tasks):
+        # new_tasks: [(task_id, task_details)], gravadas com um único commit
+        # (o próximo disparo, se já calculado, vai no mesmo INSERT)
+        rows = []
+        target_rows = []
+        for task_id, task in new_tasks:
+            row = self._to_row(task_id, task)
+            rows.append((task_id,) + row[:-1] + (task.get("next_fire_at"),))
+            target_rows.extend((task_id, group_name) for group_name in task.get("group_names", []))
+        with self._lock:
+            with self.pool.transaction() as conn:
+                conn.executemany(TASK_INSERT, rows)
+                conn.executemany(TARGET_INSERT, target_rows)
+            for task_id, task in new_tasks:
+                self._cache[task_id] = self._copy(task)
+
+    def update(self, task_id, **fields):
+        with self._lock:
+            current = self._cache.get(task_id)
+            if current is None:
+                return None
+            task = {**current, **fields}
+            with self.pool.transaction() as conn:
+                conn.execute(TASK_UPDATE, self._to_row(task_id, task))
+                if "group_names" in fields:
+                    conn.execute(TARGET_DELETE, (task_id,))
+                    conn.executemany(TARGET_INSERT, [(task_id, g) for g in task["group_names"]])
+            self._cache[task_id] = self._copy(task)
+        return self._copy(task)
+
+    def update_many(self, task_ids, fields, next_fire=None):
+        # Mesmos campos em várias tarefas, em uma transação; next_fire
+        # ({task_id: timestamp ou None}) grava o próximo disparo junto
+        next_fire = next_fire or {}
+        with self._lock:
+            updated = {
+                task_id: {**self._cache[task_id], **fields} for task_id in dict.fromkeys(task_ids) if task_id in self._cache
+            }
+            with self.pool.transaction() as conn:
+                conn.executemany(TASK_UPDATE, [self._to_row(task_id, task) for task_id, task in updated.items()])
+                conn.executemany(TASK_NEXT_FIRE_UPDATE, [
+                    (due, task_id) for task_id, due in next_fire.items() if task_id in updated
+                ])
+            for task_id, task in updated.items():
+                if task_id in next_fire:
+                    task["next_fire_at"] = next_fire[task_id]
+                self._cache[task_id] = self._copy(task)
+        return [(task_id, self._copy(task)) for task_id, task in updated.items()]
+
+    def record_fire(self, task_id, last_fired_at=None, next_fire_at=None, planned_offset=None, actual_offset=None):
+        # Grava o último disparo (se houve, com os offsets planejado e real) e
+        # o próximo prazo, usados para recuperar disparos perdidos depois de
+        # um reinício
+        with self._lock:
+            with self.pool.transaction() as conn:
+                conn.execute(TASK_FIRE_UPDATE, (last_fired_at, next_fire_at, planned_offset, actual_offset, task_id))
+            task = self._cache.get(task_id)
+            if task is not None:
+                if last_fired_at is not None:
+                    task["last_fired_at"] = last_fired_at
+                    task["planned_offset"] = planned_offset
+                    task["actual_offset"] = actual_offset
+                task["next_fire_at"] = next_fire_at
+
+    def delete(self, task_id):
+        with self._lock:
+            with self.pool.transaction() as conn:
+                conn.execute(TASK_DELETE, (task_id,))
+                conn.execute(TARGET_DELETE, (task_id,))
+            return self._cache.pop(task_id, None) is not None
+
+    def delete_many(self, task_ids):
+        with self._lock:
+            deleted = [task_id for task_id in dict.fromkeys(task_ids) if task_id in self._cache]
+            with self.pool.transaction() as conn:
+                conn.executemany(TASK_DELETE, [(task_id,) for task_id in deleted])
+                conn.executemany(TARGET_DELETE, [(task_id,) for task_id in deleted])
+            for task_id in deleted:
+                del self._cache[task_id]
+        return deleted
+
+    def query(self, status=None, group=None, kind=None, time_from=None, time_to=None,
+              fire_from=None, fire_to=None, offset=0, limit=None):
+        # Listagem filtrada e paginada direto do banco (índices de
+        # migration_task_listing_indexes); devolve (total, [(task_id, task)]).
+        # time_from/time_to comparam "HH:MM" e só valem para as tarefas diárias;
+        # fire_from/fire_to (timestamps) filtram pelo próximo disparo de qualquer tarefa.
+        where, params = [], []
+        if status:
+            where.append(f"status IN ({','.join('?' * len(status))})")
+            params.extend(status)
+        if group:
+            where.append(TASK_GROUP_FILTER)
+            params.extend((group, group))
+        if kind:
+            where.append("kind = ?")
+            params.append(kind)
+        if time_from or time_to:
+            where.append(TASK_DAILY_TIME)
+        if time_from:
+            where.append("time >= ?")
+            params.append(time_from)
+        if time_to:
+            where.append("time <= ?")
+            params.append(time_to)
+        if fire_from is not None:
+            where.append("next_fire_at >= ?")
+            params.append(fire_from)
+        if fire_to is not None:
+            where.append("next_fire_at <= ?")
+            params.append(fire_to)
+        clause = " WHERE " + " AND ".join(where) if where else ""
+        with self.pool.connection() as conn:
+            total = conn.execute("SELECT COUNT(*) FROM tasks" + clause, params).fetchone()[0]
+            rows = conn.execute(TASK_SELECT + clause + TASK_ORDER, params + [-1 if limit is None else limit, offset]).fetchall()
+            tasks = [self._from_row(row) for row in rows]
+            broadcasts = {task_id: task for task_id, task in tasks if task["kind"] == "broadcast"}
+            for chunk, marks in sql_chunks(broadcasts):
+                for task_id, group_name in conn.execute(TARGET_SELECT_IN.format(marks), chunk):
+                    broadcasts[task_id].setdefault("group_names", []).append(group_name)
+        return total, tasks
+
+    def fetch(self, task_id):
+        # Leitura direta do banco, para processos (workers) cujo cache não vê
+        # as tarefas criadas pela API
+        with self.pool.connection() as conn:
+            row = conn.execute(TASK_SELECT + " WHERE id = ?", (task_id,)).fetchone()
+            targets = conn.execute(TARGET_SELECT_TASK, (task_id,)).fetchall()
+        if row is None:
+            return None
+        task = self._from_row(row)[1]
+        if targets:
+            task["group_names"] = [group_name for _, group_name in targets]
+        return task
+
+    def reset_targets(self, task_id):
+        with self.pool.transaction() as conn:
+            conn.execute(TARGET_RESET, (time.time(), task_id))
+
+    def update_target(self, task_id, group_name, status, attempts, message_id=None, error=None):
+        with self.pool.transaction() as conn:
+            conn.execute(TARGET_UPDATE, (status, attempts, message_id, error, time.time(), task_id, group_name))
+
+    def target_progress(self, task_ids=None):
+        # {task_id: {"total": n, "pending": n, "sent": n, "failed": n}} dos envios em massa
+        progress = {}
+        with self.pool.connection() as conn:
+            if task_ids is None:
+                rows = conn.execute(TARGET_PROGRESS).fetchall()
+            else:
+                rows = [row for chunk, marks in sql_chunks(task_ids)
+                        for row in conn.execute(TARGET_PROGRESS_IN.format(marks), chunk)]
+        for task_id, status, count in rows:
+            item = progress.setdefault(task_id, {"total": 0, "pending": 0, "sent": 0, "failed": 0})
+            item["total"] += count
+            item[TARGET_STATUS.get(status, "pending")] += count
+        return progress
+
+task_repo = TaskRepository(db_pool)
+
+# Fila de Jobs
+JOB_INSERT = """
+    INSERT OR IGNORE INTO jobs (task_id, due_at, available_at, status, created_at, updated_at)
+    VALUES (?, ?, ?, 'queued', ?, ?)
+"""
+JOB_NEXT = """
+    SELECT id, task_id, due_at, attempts FROM jobs
+    WHERE available_at <= ? AND (status = 'queued' OR (status = 'leased' AND lease_expires_at < ?))
+    ORDER BY available_at
+    LIMIT 1
+"""
+JOB_LEASE = """
+    UPDATE jobs
+    SET status = 'leased', lease_owner = ?, lease_expires_at = ?, attempts = attempts + 1, updated_at = ?
+    WHERE id = ?
+"""
+JOB_EXTEND = "UPDATE jobs SET lease_expires_at = ?, updated_at = ? WHERE id = ? AND lease_owner = ?"
+JOB_DONE = """
+    UPDATE jobs SET status = 'done', lease_owner = NULL, lease_expires_at = NULL, updated_at = ?
+    WHERE id = ? AND lease_owner = ?
+"""
+JOB_RETRY = """
+    UPDATE jobs
+    SET status = ?, available_at = ?, lease_owner = NULL, lease_expires_at = NULL, last_error = ?, updated_at = ?
+    WHERE id = ? AND lease_owner = ?
+"""
+JOB_STATS = "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+JOB_PURGE = "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?"
+
+class JobQueue:
+    # Fila durável no SQLite. O processo da API (um só por banco, ver
+    # claim_api_process) enfileira os disparos, com UNIQUE por tarefa e
+    # horário para que um disparo recuperado após reinício não duplique o job,
+    # e os workers os reservam com um lease; se o worker morrer, o lease
+    # expira e outro worker assume o job.
+    def __init__(self, pool, lease_seconds=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS):
+        self.pool = pool
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+    def enqueue(self, task_id, due_at):
+        now = time.time()
+        with self.pool.transaction() as conn:
+            return conn.execute(JOB_INSERT, (task_id, due_at, due_at, now, now)).rowcount > 0
+
+    def claim(self, owner):
+        now = time.time()
+        with self.pool.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(JOB_NEXT, (now, now)).fetchone()
+                if row is not None:
+                    conn.execute(JOB_LEASE, (owner, now + self.lease_seconds, now, row[0]))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        if row is None:
+            return None
+        job_id, task_id, due_at, attempts = row
+        return {"id": job_id, "task_id": task_id, "due_at": due_at, "attempts": attempts + 1}
+
+    def extend(self, job, owner):
+        now = time.time()
+        with self.pool.transaction() as conn:
+            conn.execute(JOB_EXTEND, (now + self.lease_seconds, now, job["id"], owner))
+
+    def complete(self, job, owner):
+        with self.pool.transaction() as conn:
+            conn.execute(JOB_DONE, (time.time(), job["id"], owner))
+
+    def fail(self, job, owner, error):
+        now = time.time()
+        status = "failed" if job["attempts"] >= self.max_attempts else "queued"
+        with self.pool.transaction() as conn:
+            conn.execute(JOB_RETRY, (status, now + JOB_RETRY_DELAY * job["attempts"], error, now, job["id"], owner))
+        return status
+
+    def stats(self):
+        with self.pool.connection() as conn:
+            return dict(conn.execute(JOB_STATS).fetchall())
+
+    def purge(self, retention=JOB_RETENTION):
+        with self.pool.transaction() as conn:
+            return conn.execute(JOB_PURGE, (time.time() - retention,)).rowcount
+
+job_queue = JobQueue(db_pool)
+
+# Log de Entregas
+DELIVERY_INSERT = """
+    INSERT INTO deliveries (task_id, group_name, chat_id, account, status, message_id, attempts, latency, error, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+DELIVERY_SELECT = """
+    SELECT id, task_id, group_name, chat_id, account, status, message_id, attempts, latency, error, created_at
+    FROM deliveries
+"""
+DELIVERY_ROLLUP = """
+    INSERT INTO delivery_daily (day, task_id, group_name, sent, failed, latency_total)
+    SELECT date(created_at, 'unixepoch'), COALESCE(task_id, ''), group_name,
+           SUM(status = 'sent'), SUM(status = 'failed'), COALESCE(SUM(latency), 0)
+    FROM deliveries WHERE created_at < ?
+    GROUP BY 1, 2, 3
+    ON CONFLICT (day, task_id, group_name) DO UPDATE SET
+        sent = sent + excluded.sent,
+        failed = failed + excluded.failed,
+        latency_total = latency_total + excluded.latency_total
+"""
+DELIVERY_PURGE = "DELETE FROM deliveries WHERE created_at < ?"
+DELIVERY_ROLLUP_PURGE = "DELETE FROM delivery_daily WHERE day < date(?, 'unixepoch')"
+DELIVERY_STATS = """
+    SELECT {key}, COUNT(*), SUM(status = 'sent'), SUM(status = 'failed'), SUM(latency), MAX(created_at)
+    FROM deliveries{where} GROUP BY {key}
+"""
+DELIVERY_ROLLUP_STATS = """
+    SELECT {key}, SUM(sent + failed), SUM(sent), SUM(failed), SUM(latency_total), NULL
+    FROM delivery_daily{where} GROUP BY {key}
+"""
+
+class DeliveryLog:
+    # Histórico append-only das entregas. record() só enfileira: uma thread
+    # grava em lotes (uma transação por lote), fora do caminho do envio, e de
+    # hora em hora resume em delivery_daily o que passou da retenção.
+    def __init__(self, pool):
+        self.pool = pool
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = Lock()
+        self._compacted_at = 0
+
+    def record(self, task_id, group_name, chat_id, account, status, message_id, attempts, latency, error):
+        self._queue.put((
+            task_id, group_name, chat_id, account, TARGET_STATUS.get(status, status),
+            message_id, attempts, latency, error, time.time()
+        ))
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = Thread(target=self._run, daemon=True)
+                    self._thread.start()
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        while True:
+            rows = [self._queue.get()]
+            deadline = time.monotonic() + DELIVERY_FLUSH_INTERVAL
+            while len(rows) < DELIVERY_BATCH:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    rows.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                with self.pool.transaction() as conn:
+                    conn.executemany(DELIVERY_INSERT, rows)
+            except Exception as e:
+                print(f"Erro ao gravar o log de entregas ({len(rows)} linhas): {e}")
+            if time.time() - self._compacted_at > DELIVERY_COMPACT_INTERVAL:
+                self._compacted_at = time.time()
+                try:
+                    self.compact()
+                except Exception as e:
+                    print(f"Erro ao compactar o log de entregas: {e}")
+
+    def compact(self, now=None):
+        now = time.time() if now is None else now
+        cutoff = now - DELIVERY_RETENTION_DAYS * 86400
+        with self.pool.transaction() as conn:
+            conn.execute(DELIVERY_ROLLUP, (cutoff,))
+            removed = conn.execute(DELIVERY_PURGE, (cutoff,)).rowcount
+            conn.execute(DELIVERY_ROLLUP_PURGE, (now - DELIVERY_ROLLUP_DAYS * 86400,))
+        return removed
+
+    @staticmethod
+    def _filters(task_id=None, group=None, status=None, since=None, until=None):
+        where, params = [], []
+        for column, value in (("task_id", task_id), ("group_name", group), ("status", status)):
+            if value:
+                where.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            where.append("created_at >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("created_at < ?")
+            params.append(until)
+        return (" WHERE " + " AND ".join(where) if where else ""), params
+
+    def history(self, offset=0, limit=100, **filters):
+        where, params = self._filters(**filters)
+        with self.pool.connection() as conn:
+            total = conn.execute("SELECT COUNT(*) FROM deliveries" + where, params).fetchone()[0]
+            rows = conn.execute(
+                DELIVERY_SELECT + where + " ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?", params + [limit, offset]
+            ).fetchall()
+        columns = ("id", "task_id", "group_name", "chat_id", "account", "status",
+                   "message_id", "attempts", "latency", "error", "created_at")
+        return total, [dict(zip(columns, row)) for row in rows]
+
+    def stats(self, by="task", task_id=None, group=None, since=None, until=None):
+        # Taxa de sucesso por tarefa ou por grupo, somando o histórico
+        # detalhado e os resumos diários já compactados
+        key = "task_id" if by == "task" else "group_name"
+        where, params = self._filters(task_id=task_id, group=group, since=since, until=until)
+        rollup_where, rollup_params = [], []
+        for column, value in (("task_id", task_id), ("group_name", group)):
+            if value:
+                rollup_where.append(f"{column} = ?")
+                rollup_params.append(value)
+        if since is not None:
+            rollup_where.append("day >= date(?, 'unixepoch')")
+            rollup_params.append(since)
+        if until is not None:
+            rollup_where.append("day < date(?, 'unixepoch')")
+            rollup_params.append(until)
+        rollup_clause = " WHERE " + " AND ".join(rollup_where) if rollup_where else ""
+        with self.pool.connection() as conn:
+            rows = conn.execute(DELIVERY_STATS.format(key=key, where=where), params).fetchall()
+            rows += conn.execute(DELIVERY_ROLLUP_STATS.format(key=key, where=rollup_clause), rollup_params).fetchall()
+        stats = {}
+        for name, total, sent, failed, latency_total, last_at in rows:
+            item = stats.setdefault(name or None, {"total": 0, "sent": 0, "failed": 0, "latency_total": 0.0, "last_at": None})
+            item["total"] += total
+            item["sent"] += sent or 0
+            item["failed"] += failed or 0
+            item["latency_total"] += latency_total or 0
+            if last_at is not None:
+                item["last_at"] = max(item["last_at"] or 0, last_at)
+        result = []
+        for name, item in stats.items():
+            latency_total = item.pop("latency_total")
+            result.append({
+                key: name,
+                **item,
+                "success_rate": item["sent"] / item["total"] if item["total"] else None,
+                "avg_latency": latency_total / item["total"] if item["total"] else None,
+            })
+        result.sort(key=lambda item: item["total"], reverse=True)
+        return result
+
+delivery_log = DeliveryLog(db_pool)
+
+# Índice de Diálogos
+class DialogIndex:
+    # Índice título -> entidade e id -> entidade dos diálogos da conta. É
+    # preenchido por load_groups, atualizado pelos eventos do Telegram e
+    # recarregado por completo quando o TTL expira ou é invalidado.
+    TTL = 600
+    MISS_REFRESH_INTERVAL = 30
+
+    def __init__(self, tg_client):
+        self.client = tg_client
+        self.by_title = {}
+        self.by_id = {}
+        self.loaded_at = 0
+        self._lock = None
+
+    def fill(self, dialogs):
+        by_title, by_id = {}, {}
+        for dialog in dialogs:
+            entry = {
+                "id": dialog.id,
+                "title": dialog.name,
+                "entity": dialog.entity,
+                "is_group": dialog.is_group,
+            }
+            by_id[dialog.id] = entry
+            current = by_title.get(dialog.name)
+            if current is None or (entry["is_group"] and not current["is_group"]):
+                by_title[dialog.name] = entry
+        self.by_title, self.by_id = by_title, by_id
+        self.loaded_at = time.time()
+
+    def add(self, chat_id, title, entity, is_group=True):
+        entry = {"id": chat_id, "title": title, "entity": entity, "is_group": is_group}
+        self.remove(chat_id)
+        self.by_id[chat_id] = entry
+        self.by_title[title] = entry
+
+    def remove(self, chat_id):
+        entry = self.by_id.pop(chat_id, None)
+        if entry and self.by_title.get(entry["title"]) is entry:
+            del self.by_title[entry["title"]]
+
+    def rename(self, chat_id, new_title):
+        entry = self.by_id.get(chat_id)
+        if entry:
+            self.add(chat_id, new_title, entry["entity"], entry["is_group"])
+
+    def invalidate(self):
+        self.loaded_at = 0
+
+    def clear(self):
+        self.by_title, self.by_id = {}, {}
+        self.loaded_at = 0
+
+    def is_stale(self):
+        return time.time() - self.loaded_at > self.TTL
+
+    async def refresh(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        requested_at = time.time()
+        async with self._lock:
+            # Outro refresh pode ter terminado enquanto esperávamos o lock
+            if self.loaded_at >= requested_at:
+                return
+            self.fill(await self.client.get_dialogs())
+
+    async def resolve(self, title, groups_only=False):
+        refreshed = self.is_stale()
+        if refreshed:
+            await self.refresh()
+        entry = self.by_title.get(title)
+        if entry is None and time.time() - self.loaded_at > self.MISS_REFRESH_INTERVAL:
+            # Pode ser um grupo recém-adicionado que ainda não está no índice
+            refreshed = True
+            await self.refresh()
+            entry = self.by_title.get(title)
+        cache_requests.inc("dialogs", "miss" if refreshed else "hit")
+        if entry is None or (groups_only and not entry["is_group"]):
+            return None
+        return entry["entity"]
+
+async def on_chat_action(account, event):
+    if event.new_title:
+        account.dialogs.rename(event.chat_id, event.new_title)
+        await asyncio.to_thread(group_store.rename, account.phone, event.chat_id, event.new_title)
+        return
+    if event.user_joined or event.user_added or event.user_left or event.user_kicked:
+        await member_cache.apply_event(account, event)
+    me = await event.client.get_me(input_peer=True)
+    if me.user_id not in (event.user_ids or []):
+        return
+    if event.user_joined or event.user_added:
+        chat = await event.get_chat()
+        title = getattr(chat, "title", None)
+        is_group = is_group_entity(chat)
+        account.dialogs.add(event.chat_id, title, chat, is_group)
+        if is_group and title:
+            await asyncio.to_thread(group_store.add, account.phone, event.chat_id, title, public_link(chat))
+    elif event.user_left or event.user_kicked:
+        account.dialogs.remove(event.chat_id)
+        await asyncio.to_thread(group_store.remove, account.phone, event.chat_id)
+
+async def on_chat_update(account, update):
+    # UpdateChannel/UpdateChat chegam quando algo do chat muda (link de convite,
+    # username, permissões); o link memoizado é descartado e buscado de novo
+    # no próximo pedido
+    if isinstance(update, UpdateChannel):
+        chat_id = utils.get_peer_id(PeerChannel(update.channel_id))
+    else:
+        chat_id = utils.get_peer_id(PeerChat(update.chat_id))
+    await asyncio.to_thread(group_store.invalidate_link, account.phone, chat_id)
+
+def register_event_handlers(account):
+    async def handle_chat_action(event):
+        await on_chat_action(account, event)
+
+    async def handle_chat_update(update):
+        await on_chat_update(account, update)
+
+    account.client.add_event_handler(handle_chat_action, events.ChatAction())
+    account.client.add_event_handler(handle_chat_update, events.Raw((UpdateChannel, UpdateChat)))
+
+# Cache de Membros
+MEMBER_SELECT = "SELECT user_id, username, first_name, access_hash FROM group_members WHERE account = ? AND chat_id = ?"
+MEMBER_UPSERT = """
+    INSERT OR REPLACE INTO group_members (account, chat_id, user_id, username, first_name, access_hash)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+MEMBER_DELETE = "DELETE FROM group_members WHERE account = ? AND chat_id = ? AND user_id = ?"
+MEMBER_CLEAR = "DELETE FROM group_members WHERE account = ? AND chat_id = ?"
+MEMBER_SYNC_SELECT = "SELECT refreshed_at FROM group_member_sync WHERE account = ? AND chat_id = ?"
+MEMBER_SYNC_UPSERT = "INSERT OR REPLACE INTO group_member_sync (account, chat_id, refreshed_at) VALUES (?, ?, ?)"
+
+class MemberCache:
+    # Participantes por grupo, servidos da memória e persistidos no SQLite. A
+    # lista completa só é buscada no Telegram quando o TTL expira; entradas e
+    # saídas chegam pelos eventos e atualizam o cache incrementalmente. As
+    # chaves incluem a conta porque o access_hash dos usuários é por conta.
+    def __init__(self, pool, ttl=MEMBER_CACHE_TTL):
+        self.pool = pool
+        self.ttl = ttl
+        self._members = {}  # {(phone, chat_id): {user_id: member}}
+        self._refreshed = {}  # {(phone, chat_id): refreshed_at}
+        self._locks = {}
+
+    @staticmethod
+    def _member(user):
+        return {
+            "id": user.id,
+            "username": user.username,
+            "first_name": user.first_name,
+            "access_hash": user.access_hash,
+        }
+
+    @staticmethod
+    def _rows(key, members):
+        return [(key[0], key[1], m["id"], m["username"], m["first_name"], m["access_hash"]) for m in members]
+
+    def _is_fresh(self, key):
+        return time.time() - self._refreshed.get(key, 0) < self.ttl
+
+    def _load_stored(self, key):
+        with self.pool.connection() as conn:
+            row = conn.execute(MEMBER_SYNC_SELECT, key).fetchone()
+            if row is None:
+                return None, 0
+            rows = conn.execute(MEMBER_SELECT, key).fetchall()
+        members = {
+            user_id: {"id": user_id, "username": username, "first_name": first_name, "access_hash": access_hash}
+            for user_id, username, first_name, access_hash in rows
+        }
+        return members, row[0]
+
+    def _store_all(self, key, members, refreshed_at):
+        with self.pool.transaction() as conn:
+            conn.execute(MEMBER_CLEAR, key)
+            conn.executemany(MEMBER_UPSERT, self._rows(key, members.values()))
+            conn.execute(MEMBER_SYNC_UPSERT, key + (refreshed_at,))
+
+    def _store_changes(self, key, added, removed):
+        with self.pool.transaction() as conn:
+            conn.executemany(MEMBER_UPSERT, self._rows(key, added))
+            conn.executemany(MEMBER_DELETE, [key + (user_id,) for user_id in removed])
+
+    async def get(self, account, chat):
+        key = (account.phone, utils.get_peer_id(chat))
+        if key in self._members and self._is_fresh(key):
+            cache_requests.inc("members", "hit")
+            return list(self._members[key].values())
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if key not in self._members:
+                members, refreshed_at = await asyncio.to_thread(self._load_stored, key)
+                if members is not None:
+                    self._members[key] = members
+                    self._refreshed[key] = refreshed_at
+            if key in self._members and self._is_fresh(key):
+                cache_requests.inc("members", "hit")
+            else:
+                cache_requests.inc("members", "miss")
+                participants = await account.client.get_participants(chat)
+                members = {user.id: self._member(user) for user in participants}
+                refreshed_at = time.time()
+                await asyncio.to_thread(self._store_all, key, members, refreshed_at)
+                self._members[key] = members
+                self._refreshed[key] = refreshed_at
+        return list(self._members[key].values())
+
+    async def apply_event(self, account, event):
+        # Só grupos já em cache são atualizados; os demais serão carregados
+        # por completo no próximo acesso
+        key = (account.phone, event.chat_id)
+        members = self._members.get(key)
+        if members is None:
+            return
+        added, removed = [], []
+        if event.user_joined or event.user_added:
+            added = [self._member(user) for user in await event.get_users() if user]
+            members.update((member["id"], member) for member in added)
+        elif event.user_left or event.user_kicked:
+            removed = [user_id for user_id in (event.user_ids or []) if members.pop(user_id, None)]
+        if added or removed:
+            await asyncio.to_thread(self._store_changes, key, added, removed)
+
+    def clear(self, phone=None):
+        for key in [key for key in self._members if phone is None or key[0] == phone]:
+            del self._members[key]
+            self._refreshed.pop(key, None)
+
+member_cache = MemberCache(db_pool)
+
+# Lista de Grupos
+GROUP_SELECT = "SELECT account, chat_id, title, link, link_fetched_at FROM chat_groups ORDER BY rowid"
+GROUP_UPSERT = """
+    INSERT OR REPLACE INTO chat_groups (account, chat_id, title, link, link_fetched_at)
+    VALUES (?, ?, ?, ?, ?)
+"""
+GROUP_RENAME = "UPDATE chat_groups SET title = ? WHERE account = ? AND chat_id = ?"
+GROUP_LINK_UPDATE = "UPDATE chat_groups SET link = ?, link_fetched_at = ? WHERE account = ? AND chat_id = ?"
+GROUP_DELETE = "DELETE FROM chat_groups WHERE account = ? AND chat_id = ?"
+GROUP_CLEAR = "DELETE FROM chat_groups WHERE account = ?"
+
+def is_group_entity(entity):
+    return isinstance(entity, Chat) or bool(getattr(entity, "megagroup", False))
+
+def public_link(entity):
+    username = getattr(entity, "username", None)
+    return f"https://t.me/{username}" if username else None
+
+async def fetch_invite_link(account, entity, bucket, attempts=3):
+    for _ in range(attempts):
+        await bucket.acquire()
+        try:
+            if isinstance(entity, Channel):
+                full = await account.client(GetFullChannelRequest(channel=entity))
+            else:
+                full = await account.client(GetFullChatRequest(chat_id=entity.id))
+            invite = full.full_chat.exported_invite
+            return invite.link if invite else public_link(entity)
+        except FloodWaitError as e:
+            bucket.pause(e.seconds)
+        except Exception as e:
+            print(f"Erro ao buscar o link de convite de {getattr(entity, 'title', entity)}: {e}")
+            break
+    return public_link(entity)
+
+class GroupStore:
+    # Grupos de cada conta, servidos da memória (a lista pronta fica guardada
+    # até a próxima mudança) e persistidos no SQLite, então sobrevivem a um
+    # reinício. load_groups preenche a lista no login; depois ela é mantida
+    # pelos eventos do Telegram. Os links de convite custam um GetFull* por
+    # grupo e só são buscados quando pedidos, ficando memoizados.
+    def __init__(self, pool):
+        self.pool = pool
+        self._groups = {}  # {(phone, chat_id): grupo}, na ordem em que entraram
+        self._fetched = {}  # {(phone, chat_id): link_fetched_at}
+        self._snapshot = None
+        self._fetching = {}  # {(phone, chat_id): Future} das buscas de link em andamento
+        self._bucket = None
+        self._lock = Lock()
+
+    @staticmethod
+    def _entry(phone, chat_id, title, link):
+        return {"id": chat_id, "title": title, "link": link, "account": phone}
+
+    def load(self):
+        with self.pool.connection() as conn:
+            rows = conn.execute(GROUP_SELECT).fetchall()
+        with self._lock:
+            self._groups, self._fetched = {}, {}
+            for phone, chat_id, title, link, fetched_at in rows:
+                self._groups[(phone, chat_id)] = self._entry(phone, chat_id, title, link)
+                if fetched_at is not None:
+                    self._fetched[(phone, chat_id)] = fetched_at
+            self._snapshot = None
+
+    def replace(self, phone, groups):
+        # Resultado de um load_groups completo ([(chat_id, título, link público)]);
+        # os links já memoizados dos grupos que continuam são preservados
+        rows = []
+        with self._lock:
+            for chat_id, title, link in groups:
+                current = self._groups.get((phone, chat_id))
+                fetched_at = self._fetched.get((phone, chat_id))
+                if fetched_at is not None:
+                    link = current["link"]
+                rows.append((phone, chat_id, title, link, fetched_at))
+        with self.pool.transaction() as conn:
+            conn.execute(GROUP_CLEAR, (phone,))
+            conn.executemany(GROUP_UPSERT, rows)
+        with self._lock:
+            self._drop(lambda key: key[0] == phone)
+            for row in rows:
+                self._groups[row[:2]] = self._entry(*row[:4])
+                if row[4] is not None:
+                    self._fetched[row[:2]] = row[4]
+            self._snapshot = None
+
+    def add(self, phone, chat_id, title, link=None):
+        with self.pool.transaction() as conn:
+            conn.execute(GROUP_UPSERT, (phone, chat_id, title, link, None))
+        with self._lock:
+            self._groups[(phone, chat_id)] = self._entry(phone, chat_id, title, link)
+            self._fetched.pop((phone, chat_id), None)
+            self._snapshot = None
+
+    def rename(self, phone, chat_id, title):
+        with self._lock:
+            group = self._groups.get((phone, chat_id))
+            if group is None:
+                return
+        with self.pool.transaction() as conn:
+            conn.execute(GROUP_RENAME, (title, phone, chat_id))
+        with self._lock:
+            self._groups[(phone, chat_id)] = dict(group, title=title)
+            self._snapshot = None
+
+    def remove(self, phone, chat_id):
+        with self.pool.transaction() as conn:
+            conn.execute(GROUP_DELETE, (phone, chat_id))
+        with self._lock:
+            self._drop(lambda key: key == (phone, chat_id))
+            self._snapshot = None
+
+    def clear(self, phones):
+        with self.pool.transaction() as conn:
+            conn.executemany(GROUP_CLEAR, [(phone,) for phone in phones])
+        with self._lock:
+            self._drop(lambda key: key[0] in phones)
+            self._snapshot = None
+
+    def _drop(self, match):
+        for key in [key for key in self._groups if match(key)]:
+            del self._groups[key]
+            self._fetched.pop(key, None)
+
+    def set_link(self, phone, chat_id, link, fetched_at):
+        with self.pool.transaction() as conn:
+            conn.execute(GROUP_LINK_UPDATE, (link, fetched_at, phone, chat_id))
+        with self._lock:
+            group = self._groups.get((phone, chat_id))
+            if group is None:
+                return
+            self._groups[(phone, chat_id)] = dict(group, link=link)
+            if fetched_at is None:
+                self._fetched.pop((phone, chat_id), None)
+            else:
+                self._fetched[(phone, chat_id)] = fetched_at
+            self._snapshot = None
+
+    def invalidate_link(self, phone, chat_id):
+        # O link antigo continua na lista até o novo ser buscado
+        if (phone, chat_id) in self._fetched:
+            group = self._groups[(phone, chat_id)]
+            self.set_link(phone, chat_id, group["link"], None)
+
+    def find(self, chat_id, phone=None):
+        with self._lock:
+            if phone is not None:
+                return self._groups.get((phone, chat_id))
+            return next((group for key, group in self._groups.items() if key[1] == chat_id), None)
+
+    def all(self):
+        # Um item por chat, com as contas que participam dele em "accounts"
+        # ("account" é a primeira). A mesma lista é devolvida até a próxima
+        # mudança: /groups não copia nada
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                merged = {}
+                for (phone, chat_id), group in self._groups.items():
+                    entry = merged.get(chat_id)
+                    if entry is None:
+                        merged[chat_id] = dict(group, accounts=[phone])
+                        continue
+                    entry["accounts"].append(phone)
+                    if entry["link"] is None:
+                        entry["link"] = group["link"]
+                snapshot = self._snapshot = list(merged.values())
+        return snapshot
+
+    def __len__(self):
+        return len(self._groups)
+
+    async def invite_link(self, account, chat_id):
+        key = (account.phone, chat_id)
+        fetched_at = self._fetched.get(key)
+        if fetched_at is not None and time.time() - fetched_at < INVITE_LINK_TTL:
+            cache_requests.inc("invite_links", "hit")
+            return self._groups[key]["link"]
+        # Pedidos simultâneos do mesmo grupo compartilham uma única busca
+        pending = self._fetching.get(key)
+        if pending is None:
+            cache_requests.inc("invite_links", "miss")
+            pending = self._fetching[key] = asyncio.ensure_future(self._fetch_link(account, chat_id))
+            pending.add_done_callback(lambda _: self._fetching.pop(key, None))
+        return await asyncio.shield(pending)
+
+    async def _fetch_link(self, account, chat_id):
+        if self._bucket is None:
+            self._bucket = TokenBucket(GROUP_LOAD_RATE)
+        entry = account.dialogs.by_id.get(chat_id)
+        entity = entry["entity"] if entry else await account.client.get_entity(chat_id)
+        link = await fetch_invite_link(account, entity, self._bucket)
+        await asyncio.to_thread(self.set_link, account.phone, chat_id, link, time.time())
+        return link
+
+group_store = GroupStore(db_pool)
+
+# Marcação de Membros
+def mention_label(member):
+    if member["username"]:
+        return f"@{member['username']}"
+    return member["first_name"] or None
+
+def mention_markdown(member):
+    if member["username"]:
+        return f"@{member['username']}"
+    return f"[{member['first_name']}](tg://user?id={member['id']})"
+
+def utf16_len(text):
+    return len(text.encode("utf-16-le")) // 2
+
+def build_mention_chunks(members, max_length=MESSAGE_MAX_LENGTH, max_mentions=MENTIONS_PER_MESSAGE):
+    # Gera (texto, menções) em blocos dentro dos limites de tamanho e de
+    # menções por mensagem; cada menção é (offset, length, membro), com offsets
+    # em UTF-16 para virar entidade MessageEntityMentionName sem parse de markdown
+    parts, mentions, length = [], [], 0
+    for member in members:
+        label = mention_label(member)
+        if label is None:
+            continue
+        label_length = utf16_len(label)
+        if parts and (length + 1 + label_length > max_length or len(mentions) >= max_mentions):
+            yield "".join(parts), mentions
+            parts, mentions, length = [], [], 0
+        if parts:
+            parts.append(" ")
+            length += 1
+        mentions.append((length, label_length, member))
+        parts.append(label)
+        length += label_length
+    if parts:
+        yield "".join(parts), mentions
+
+def mention_entities(mentions):
+    return [
+        InputMessageEntityMentionName(offset, length, InputUser(member["id"], member["access_hash"] or 0))
+        for offset, length, member in mentions
+    ]
+
+def mention_chunk_json(text, mentions):
+    return {
+        "text": text,
+        "mentions": [{"offset": offset, "length": length, "user_id": member["id"]} for offset, length, member in mentions],
+    }
+
+class MentionQueue:
+    # Fila das mensagens de marcação de uma conta, enviadas em ritmo constante
+    def __init__(self, account, interval=MENTION_SEND_INTERVAL):
+        self.account = account
+        self.interval = interval
+        self._queue = None
+        self._worker = None
+
+    def put(self, chat, text, entities):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._run())
+        self._queue.put_nowait((chat, text, entities))
+
+    def pending(self):
+        return self._queue.qsize() if self._queue else 0
+
+    async def _run(self):
+        while True:
+            chat, text, entities = await self._queue.get()
+            for _ in range(2):
+                try:
+                    await self.account.client.send_message(chat, text, formatting_entities=entities)
+                    break
+                except FloodWaitError as e:
+                    await asyncio.sleep(e.seconds)
+                except Exception as e:
+                    print(f"Erro ao enviar mensagem de marcação: {e}")
+                    break
+            await asyncio.sleep(self.interval)
+
+# Contas
+class Account:
+    # Uma sessão autenticada do Telegram, com seu índice de diálogos, sua fila
+    # de envio (ACCOUNT_SEND_CONCURRENCY workers) e seu estado de saúde
+    def __init__(self, phone, tg_client):
+        self.phone = phone
+        self.client = tg_client
+        self.dialogs = DialogIndex(tg_client)
+        self.mentions = MentionQueue(self)
+        self.health = "conectando"
+        self.last_error = None
+        self.flood_until = 0
+        self.sent = 0
+        self.failed = 0
+        self._queue = None
+        self._workers = []
+        self._active = 0
+        register_event_handlers(self)
+
+    async def connect(self):
+        try:
+            await self.client.connect()
+            self.health = "ok" if await self.client.is_user_authorized() else "desconectado"
+        except Exception as e:
+            self.health = "erro"
+            self.last_error = str(e)
+
+    def flood_deadline(self):
+        # Fim do FloodWait de envio: o registrado pela fila ou a pausa do limitador
+        limiter = getattr(self.client, "limiter", None)
+        paused = limiter.send_paused_for() if limiter is not None else 0
+        return max(self.flood_until, time.time() + paused if paused else 0)
+
+    def in_flood_wait(self):
+        return time.time() < self.flood_deadline()
+
+    def pending(self):
+        return (self._queue.qsize() if self._queue else 0) + self._active
+
+    async def submit(self, job):
+        # job recebe a conta e devolve uma corrotina; roda na fila desta sessão
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        self._workers = [worker for worker in self._workers if not worker.done()]
+        while len(self._workers) < ACCOUNT_SEND_CONCURRENCY:
+            self._workers.append(asyncio.ensure_future(self._run()))
+        future = asyncio.get_running_loop().create_future()
+        # O span de quem pediu o envio segue junto para o worker
+        self._queue.put_nowait((job, future, current_span.get()))
+        return await future
+
+    async def _run(self):
+        while True:
+            job, future, span = await self._queue.get()
+            if future.done():
+                continue
+            self._active += 1
+            token = current_span.set(span)
+            try:
+                result = await job(self)
+            except FloodWaitError as e:
+                self.flood_until = max(self.flood_until, time.time() + e.seconds)
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            except Exception as e:
+                self.last_error = str(e)
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.sent += 1
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                current_span.reset(token)
+                self._active -= 1
+
+    def status(self):
+        health = self.health
+        if health == "ok" and not self.client.is_connected():
+            health = "desconectado"
+        elif health == "ok" and self.in_flood_wait():
+            health = "flood_wait"
+        return {
+            "phone": self.phone,
+            "health": health,
+            "flood_wait_seconds": max(0, round(self.flood_deadline() - time.time())),
+            "queue": self.pending(),
+            "mention_queue": self.mentions.pending(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "last_error": self.last_error,
+        }
+
+class SessionPool:
+    # Registro das contas autenticadas. Cada envio vai para uma conta que
+    # participa do grupo, evitando as que estão em FloodWait e as mais ocupadas.
+    def __init__(self):
+        self.accounts = {}  # {phone: Account}
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def add(self, account):
+        self.accounts[account.phone] = account
+
+    def remove(self, phone):
+        return self.accounts.pop(phone, None)
+
+    def get(self, phone):
+        return self.accounts.get(phone)
+
+    def all(self):
+        return list(self.accounts.values())
+
+    async def candidates(self, group_name, groups_only=True):
+        found = []
+        for account in self.all():
+            if account.health == "desconectado":
+                continue
+            try:
+                chat = await account.dialogs.resolve(group_name, groups_only=groups_only)
+            except Exception as e:
+                account.last_error = str(e)
+                continue
+            if chat is not None:
+                found.append((account, chat))
+        return found
+
+    async def pick(self, group_name, groups_only=True):
+        found = await self.candidates(group_name, groups_only)
+        if not found:
+            return None, None
+        return min(found, key=lambda item: (
+            item[0].in_flood_wait(),
+            item[0].flood_deadline() if item[0].in_flood_wait() else 0,
+            item[0].pending(),
+        ))
+
+    async def next_available_in(self, group_name):
+        # Segundos até alguma conta do grupo sair do FloodWait (0 se há uma livre)
+        waits = [account.flood_deadline() - time.time() for account, _ in await self.candidates(group_name)]
+        return max(0, min(waits)) if waits else 0
+
+session_pool = SessionPool()
 
 # Funções Assíncronas
 async def send_code_request(api_id_local, api_hash_local, phone):
     global client
     try:
-        client = TelegramClient(StringSession(), int(api_id_local), api_hash_local)
+        client = create_client(StringSession(), api_id_local, api_hash_local)
         await client.connect()
         await client.send_code_request(phone)
         return True, "Código enviado com sucesso!"
@@ -103,74 +1925,544 @@ async def do_authenticate(phone, code):
     global authenticated, authenticated_phone
     try:
         await client.sign_in(phone, code)
+
+        # Salva o login no banco (um registro por telefone)
+        with db_pool.transaction() as conn:
+            conn.execute("DELETE FROM login WHERE phone = ?", (phone,))
+            conn.execute("INSERT INTO login (api_id, api_hash, phone, session) VALUES (?, ?, ?, ?)",
+                         (api_id, api_hash, phone, client.session.save()))
+
+        # Um novo login da mesma conta substitui a sessão anterior
+        previous = session_pool.remove(phone)
+        if previous:
+            previous.dialogs.clear()
+            if previous.client is not client:
+                await previous.client.disconnect()
+        account = Account(phone, client)
+        account.health = "ok"
+        session_pool.add(account)
         authenticated = True
         authenticated_phone = phone
 
-        # Salva o login no banco
-        conn = sqlite3.connect(db_file)
-        c = conn.cursor()
-        c.execute("INSERT INTO login (api_id, api_hash, phone, session) VALUES (?, ?, ?, ?)",
-                  (api_id, api_hash, phone, client.session.save()))
-        conn.commit()
-        conn.close()
-
         return True, "Autenticado com sucesso!"
     except SessionPasswordNeededError:
         return False, "Senha de dois fatores necessária!"
     except Exception as e:
         return False, f"Erro ao autenticar: {e}"
 
-async def load_groups():
-    global groups_cache
+async def load_groups(account):
+    # Recarrega a lista completa de uma conta com um único get_dialogs (sem
+    # GetFull* por grupo: os links de convite vêm sob demanda). Só roda no
+    # login; depois a lista é mantida pelos eventos. Os grupos das outras
+    # contas continuam na lista.
+    global groups_loading, groups_load_error
+    groups_loading = True
+    groups_load_error = None
     try:
-        dialogs = await client.get_dialogs()
-        groups_info = []
-        for dialog in dialogs:
-            if dialog.is_group:
-                entity = dialog.entity
-                link = None
-                if dialog.is_channel:
-                    full = await client(GetFullChannelRequest(channel=entity))
-                    invite = full.full_chat.exported_invite
-                    if invite:
-                        link = invite.link
-                    elif hasattr(entity, 'username') and entity.username:
-                        link = f"https://t.me/{entity.username}"
-                else:
-                    full = await client(GetFullChatRequest(chat_id=entity.id))
-                    invite = full.full_chat.exported_invite
-                    if invite:
-                        link = invite.link
+        dialogs = await account.client.get_dialogs()
+        account.dialogs.fill(dialogs)
+        groups = [(dialog.id, dialog.title, public_link(dialog.entity)) for dialog in dialogs if dialog.is_group]
+        await asyncio.to_thread(group_store.replace, account.phone, groups)
+        return True, [group for group in group_store.all() if account.phone in group["accounts"]]
+    except Exception as e:
+        groups_load_error = f"Erro ao carregar grupos: {e}"
+        return False, groups_load_error
+    finally:
+        groups_loading = False
+
+async def send_image_to_group(group_name, image_path, text="", task_id=None):
+    # Mesmo caminho do envio em massa: FloodWait espera ou troca de conta em
+    # vez de descartar o envio
+    try:
+        status, attempts, _, error = await deliver_to_group(
+            group_name, image_path, text, asyncio.Semaphore(1), task_id=task_id
+        )
+    except Exception as e:
+        status, attempts, error = "Falhou", 0, str(e)
+    if status != "Enviado":
+        print(f"Erro ao enviar imagem para o grupo {group_name} após {attempts} tentativa(s): {error}")
+
+# Envio em Massa
+def task_group_names(task):
+    if task.get("kind") == "broadcast":
+        return task.get("group_names", [])
+    return [task["group_name"]]
+
+def unique_group_names(group_names):
+    # Lista de nomes (sem repetição, na ordem recebida); uma string sozinha
+    # viraria um grupo por caractere
+    if not isinstance(group_names, list) or not all(isinstance(name, str) and name for name in group_names):
+        raise ValueError("group_names deve ser uma lista de nomes de grupos")
+    return list(dict.fromkeys(group_names))
+
+async def deliver_to_group(group_name, image_path, text, semaphore, task_id=None):
+    # Envia para um grupo com novas tentativas; FloodWait espera o tempo pedido
+    # pelo Telegram só para este chat, sem ocupar uma vaga do pipeline. Cada
+    # tentativa escolhe a conta de novo, então outra conta livre assume o envio.
+    # O resultado vai para o log de entregas.
+    started = time.time()
+    status, attempts, message_id, error = "Falhou", BROADCAST_MAX_ATTEMPTS, None, None
+    account = chat = None
+    for attempt in range(1, BROADCAST_MAX_ATTEMPTS + 1):
+        with tracer.span("pick_account", group=group_name):
+            account, chat = await session_pool.pick(group_name)
+        if chat is None:
+            status, attempts, error = "Falhou", attempt - 1, "Grupo não encontrado"
+            break
+        try:
+            async with semaphore:
+                with tracer.span("send", group=group_name, account=account.phone, attempt=attempt):
+                    message = await account.submit(lambda acc: media_store.send(acc, chat, image_path, caption=text))
+            status, attempts, message_id, error = "Enviado", attempt, getattr(message, "id", None), None
+            break
+        except FloodWaitError as e:
+            error = f"FloodWait de {e.seconds}s"
+            delay = min(e.seconds, await session_pool.next_available_in(group_name))
+        except Exception as e:
+            error = str(e)
+            delay = BROADCAST_BACKOFF * 2 ** (attempt - 1)
+        if attempt < BROADCAST_MAX_ATTEMPTS:
+            await asyncio.sleep(delay)
+    delivery_log.record(
+        task_id, group_name, utils.get_peer_id(chat) if chat is not None else None,
+        account.phone if account is not None else None,
+        status, message_id, attempts, time.time() - started, error
+    )
+    return status, attempts, message_id, error
 
-                groups_info.append({"title": dialog.title, "link": link})
+async def run_broadcast(task_id, task):
+    # A mídia é enviada ao Telegram uma vez (MediaStore) e reutilizada por
+    # todos os grupos; o status de cada grupo é gravado assim que termina
+    await asyncio.to_thread(task_repo.reset_targets, task_id)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
 
-        groups_cache = groups_info
-        return True, groups_info
-    except Exception as e:
-        return False, f"Erro ao carregar grupos: {e}"
+    async def deliver(group_name):
+        status, attempts, message_id, error = await deliver_to_group(
+            group_name, task["image"], task["text"], semaphore, task_id=task_id
+        )
+        if error:
+            print(f"Erro ao enviar imagem para o grupo {group_name}: {error}")
+        await asyncio.to_thread(task_repo.update_target, task_id, group_name, status, attempts, message_id, error)
+
+    await asyncio.gather(*(deliver(group_name) for group_name in task_group_names(task)))
 
-async def send_image_to_group(group_name, image_path, text=""):
+async def prestage_task(task_id, task):
+    # Roda PRESTAGE_LEAD_SECONDS antes do prazo: resolve os grupos (o índice de
+    # diálogos fica quente para o disparo) e faz o upload da mídia na conta que
+    # seria escolhida agora. No prazo só resta o send_file.
     try:
-        dialogs = await client.get_dialogs()
-        chat = next(dialog for dialog in dialogs if dialog.is_group and dialog.title == group_name)
-        await client.send_file(chat, image_path, caption=text)
+        for group_name in task_group_names(task):
+            account, chat = await session_pool.pick(group_name)
+            if chat is not None and task.get("image"):
+                await media_store.prestage(account, task["image"])
+        prestages.inc("ok")
     except Exception as e:
-        print(f"Erro ao enviar imagem para o grupo {group_name}: {e}")
+        prestages.inc("error")
+        print(f"Erro na pré-preparação da tarefa {task_id}: {e}")
+
+async def execute_task(task_id, task):
+    # Usado pelos workers: a falha de um envio simples sobe como exceção para
+    # que o job volte para a fila
+    if task.get("kind") == "broadcast":
+        await run_broadcast(task_id, task)
+        return
+    status, _, _, error = await deliver_to_group(
+        task["group_name"], task["image"], task["text"], asyncio.Semaphore(1), task_id=task_id
+    )
+    if status != "Enviado":
+        raise RuntimeError(error)
+
+# Agendador
+class CronSchedule:
+    # Expressão cron de 5 campos (minuto hora dia mês dia-da-semana), com "*",
+    # listas "1,15", intervalos "9-18" e passos "*/10". Dia-da-semana: 0 ou 7
+    # é domingo; se dia e dia-da-semana forem restritos, vale qualquer um deles.
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+    SEARCH_DAYS = 366 * 8
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"Expressão cron inválida: {expr}")
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse(field, lo, hi) for field, (lo, hi) in zip(fields, self.RANGES)
+        )
+        self.weekdays = {day % 7 for day in weekdays}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def _parse(field, lo, hi):
+        values = set()
+        for part in field.split(","):
+            base, _, step = part.partition("/")
+            try:
+                step = int(step) if step else 1
+                if base == "*":
+                    start, end = lo, hi
+                elif "-" in base:
+                    start, end = (int(v) for v in base.split("-", 1))
+                else:
+                    start = int(base)
+                    end = hi if "/" in part else start
+            except ValueError:
+                raise ValueError(f"Campo cron inválido: {field}")
+            if step < 1 or not lo <= start <= end <= hi:
+                raise ValueError(f"Campo cron inválido: {field}")
+            values.update(range(start, end + 1, step))
+        return sorted(values)
+
+    def _day_matches(self, day):
+        in_days = day.day in self.days
+        in_weekdays = (day.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def next_after(self, ts, tz=None):
+        # Primeiro horário estritamente depois de ts, percorrendo os dias no
+        # relógio local do fuso (horários no buraco do horário de verão são
+        # convertidos pelo zoneinfo para o instante equivalente)
+        start = datetime.fromtimestamp(ts, tz).replace(tzinfo=None, second=0, microsecond=0)
+        day = start.replace(hour=0, minute=0)
+        for _ in range(self.SEARCH_DAYS):
+            if day.month in self.months and self._day_matches(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        candidate = day.replace(hour=hour, minute=minute)
+                        if candidate < start:
+                            continue
+                        fire_at = candidate.replace(tzinfo=tz).timestamp() if tz else candidate.timestamp()
+                        if fire_at > ts:
+                            return fire_at
+            day += timedelta(days=1)
+        return None
+
+@lru_cache(maxsize=1024)
+def parse_schedule(spec):
+    # "HH:MM" é o atalho de sempre para um disparo diário
+    try:
+        target = datetime.strptime(spec, "%H:%M")
+        return CronSchedule(f"{target.minute} {target.hour} * * *")
+    except ValueError:
+        return CronSchedule(spec)
+
+@lru_cache(maxsize=64)
+def get_timezone(name):
+    name = name or SCHEDULER_TIMEZONE
+    if not name:
+        return None
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Fuso horário inválido: {name}")
+
+def normalize_time(spec):
+    # "9:05" vira "09:05", o formato em que as tarefas diárias são gravadas e
+    # filtradas; expressões cron ficam como vieram
+    try:
+        return datetime.strptime(spec, "%H:%M").strftime("%H:%M")
+    except (TypeError, ValueError):
+        return spec
+
+def validate_schedule(spec, timezone=None):
+    # Devolve o horário normalizado; recusa os que nunca disparam ("0 0 31 2 *")
+    if not isinstance(spec, str):
+        raise ValueError("Horário inválido: use \"HH:MM\" ou uma expressão cron")
+    schedule = parse_schedule(spec)
+    if schedule.next_after(time.time(), get_timezone(timezone)) is None:
+        raise ValueError(f"Horário nunca dispara: {spec}")
+    return normalize_time(spec)
+
+def validate_dispatch(spread_seconds=None, priority=0):
+    if spread_seconds is not None and (
+        isinstance(spread_seconds, bool) or not isinstance(spread_seconds, int)
+        or not 0 <= spread_seconds <= SPREAD_MAX_SECONDS
+    ):
+        raise ValueError(f"spread_seconds inválido: use um inteiro entre 0 e {SPREAD_MAX_SECONDS} (ou null para o padrão)")
+    if isinstance(priority, bool) or not isinstance(priority, int):
+        raise ValueError("priority inválida: use um inteiro (maior sai primeiro)")
+
+def task_spread(task):
+    spread = task.get("spread_seconds")
+    return DISPATCH_SPREAD_SECONDS if spread is None else spread
+
+def next_fire_at(spec, after=None, timezone=None):
+    # Próximo disparo (timestamp) depois de "after". Sem "after", um horário
+    # que caiu no último minuto ainda dispara imediatamente, como no
+    # agendamento antigo.
+    try:
+        schedule = parse_schedule(spec)
+        tz = get_timezone(timezone)
+    except (TypeError, ValueError):
+        return None
+    after = time.time() - 60 if after is None else after
+    return schedule.next_after(after, tz)
+
+class TaskScheduler:
+    # Um único agendador para todas as tarefas: os próximos disparos ficam num
+    # min-heap e o loop dorme até o prazo mais próximo. Entradas removidas ou
+    # reagendadas são invalidadas pelo número de sequência (remoção preguiçosa).
+    # Um segundo heap, com as mesmas sequências, acorda o loop
+    # PRESTAGE_LEAD_SECONDS antes de cada prazo para a pré-preparação. Tarefas
+    # que vencem juntas são espalhadas pela janela de cada uma (_plan): as
+    # adiadas voltam ao heap no horário planejado.
+    MAX_SLEEP = 60
+    LAG_WINDOW = 1000
+
+    def __init__(self):
+        self.loop = None
+        self._heap = []  # [(due_ts, seq, task_id)]
+        self._stage_heap = []  # [(stage_ts, seq, task_id, due_ts)]
+        self._planned = {}  # {task_id: (due_ts, offset)} das entradas adiadas pelo plano
+        self._entries = {}  # {task_id: seq da entrada válida}
+        self._seq = itertools.count()
+        self._stale = 0
+        self._lock = Lock()
+        self._wakeup = None
+        self._fires = 0
+        self._lag_total = 0.0
+        self._lag_max = 0.0
+        self._recent = deque(maxlen=self.LAG_WINDOW)
+        self._misfires = 0
+        self._coalesced = 0
+        self._prestaged = 0
+
+    def start(self, loop):
+        self.loop = loop
+        asyncio.run_coroutine_threadsafe(self._run(), loop)
+
+    def schedule(self, task_id, task, after=None):
+        due = next_fire_at(task["time"], after, task.get("timezone"))
+        if due is None:
+            print(f"Horário inválido para a tarefa {task_id}: {task['time']}")
+            self.cancel(task_id)
+            return None
+        self._push(task_id, due)
+        task_repo.record_fire(task_id, next_fire_at=due)
+        return due
+
+    def restore(self, task_id, task):
+        # Depois de um reinício, retoma o prazo gravado mesmo que já tenha
+        # passado: _fire decide se ele ainda está na janela de tolerância
+        due = task.get("next_fire_at")
+        last = task.get("last_fired_at")
+        if due is not None and (last is None or due > last):
+            self._push(task_id, due)
+            return due
+        return self.schedule(task_id, task, after=last)
+
+    def _push(self, task_id, due):
+        self.push_many({task_id: due})
+
+    def push_many(self, dues):
+        # Vários prazos já calculados ({task_id: timestamp}) com um único lock
+        # e um único despertar do loop
+        with self._lock:
+            for task_id, due in dues.items():
+                if task_id in self._entries:
+                    self._stale += 1
+                self._planned.pop(task_id, None)
+                seq = next(self._seq)
+                self._entries[task_id] = seq
+                heapq.heappush(self._heap, (due, seq, task_id))
+                if PRESTAGE_LEAD_SECONDS > 0:
+                    heapq.heappush(self._stage_heap, (due - PRESTAGE_LEAD_SECONDS, seq, task_id, due))
+        self._wake()
+
+    def cancel(self, task_id):
+        self.cancel_many([task_id])
+
+    def cancel_many(self, task_ids):
+        with self._lock:
+            for task_id in task_ids:
+                if self._entries.pop(task_id, None) is not None:
+                    self._stale += 1
+                self._planned.pop(task_id, None)
+            self._compact()
+
+    def _compact(self):
+        # Reconstrói o heap quando metade das entradas está obsoleta
+        if self._stale > 64 and self._stale * 2 > len(self._heap):
+            self._heap = [e for e in self._heap if self._entries.get(e[2]) == e[1]]
+            heapq.heapify(self._heap)
+            self._stage_heap = [e for e in self._stage_heap if self._entries.get(e[2]) == e[1]]
+            heapq.heapify(self._stage_heap)
+            self._stale = 0
+
+    def _wake(self):
+        if self.loop and self._wakeup:
+            self.loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _pop_due(self, now):
+        due, staging = [], []
+        with self._lock:
+            # Antes dos disparos: a entrada ainda é válida. Prazos que já
+            # chegaram não são pré-preparados (o disparo vem em seguida).
+            while self._stage_heap and self._stage_heap[0][0] <= now:
+                _, seq, task_id, due_ts = heapq.heappop(self._stage_heap)
+                if self._entries.get(task_id) == seq and due_ts > now:
+                    staging.append(task_id)
+            while self._heap and self._heap[0][0] <= now:
+                due_ts, seq, task_id = heapq.heappop(self._heap)
+                if self._entries.get(task_id) != seq:
+                    self._stale -= 1
+                    continue
+                del self._entries[task_id]
+                # Entradas adiadas pelo plano voltam com o prazo original e o offset
+                due_ts, offset = self._planned.pop(task_id, (due_ts, None))
+                due.append((task_id, due_ts, offset))
+            timeout = self._heap[0][0] - now if self._heap else self.MAX_SLEEP
+            if self._stage_heap:
+                timeout = min(timeout, self._stage_heap[0][0] - now)
+        return due, staging, min(max(timeout, 0), self.MAX_SLEEP)
+
+    async def _run(self):
+        self._wakeup = asyncio.Event()
+        while True:
+            self._wakeup.clear()
+            due, staging, timeout = self._pop_due(time.time())
+            for task_id in staging:
+                self._prestage(task_id)
+            if due:
+                self._dispatch(due)
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch(self, due):
+        now = time.time()
+        fresh = [(task_id, due_ts) for task_id, due_ts, offset in due if offset is None]
+        planned = [(task_id, due_ts, offset) for task_id, due_ts, offset in due if offset is not None]
+        for task_id, due_ts, offset in planned + self._plan(fresh):
+            if due_ts + offset > now:
+                self._defer(task_id, due_ts, offset)
+            else:
+                self._fire(task_id, due_ts, offset)
+
+    def _plan(self, fresh):
+        # As tarefas que vencem no mesmo instante com a mesma janela formam um
+        # fluxo uniforme: a i-ésima de n, por prioridade, sai i * janela / n
+        # segundos depois do horário. Sem janela, saem juntas (na mesma ordem).
+        streams = {}
+        for task_id, due_ts in fresh:
+            task = task_repo.get(task_id) or {}
+            streams.setdefault((due_ts, task_spread(task)), []).append((-(task.get("priority") or 0), task_id))
+        plan = []
+        for (due_ts, spread), items in streams.items():
+            items.sort()
+            plan.extend((task_id, due_ts, i * spread / len(items)) for i, (_, task_id) in enumerate(items))
+        plan.sort(key=lambda item: item[2])
+        return plan
+
+    def _defer(self, task_id, due_ts, offset):
+        with self._lock:
+            # Reagendada enquanto o lote era planejado: o novo prazo prevalece
+            if task_id in self._entries:
+                return
+            seq = next(self._seq)
+            self._entries[task_id] = seq
+            self._planned[task_id] = (due_ts, offset)
+            heapq.heappush(self._heap, (due_ts + offset, seq, task_id))
+
+    def _prestage(self, task_id):
+        # No modo fila quem envia são os workers, em outro processo: o upload
+        # feito aqui não serviria para eles
+        task = task_repo.get(task_id)
+        if not task or task.get("status") != "Rodando" or EXECUTION_MODE == "queue":
+            return
+        self._prestaged += 1
+        asyncio.ensure_future(prestage_task(task_id, task))
+
+    def _fire(self, task_id, due_ts, offset=0.0):
+        task = task_repo.get(task_id)
+        if not task or task.get("status") != "Rodando":
+            return
+        fired_at = time.time()
+        # Atraso e tolerância contam a partir do horário planejado (com o offset)
+        run = fired_at - (due_ts + offset) <= MISFIRE_GRACE_SECONDS
+        if run:
+            next_due = next_fire_at(task["time"], due_ts, task.get("timezone"))
+            if CATCH_UP_POLICY == "latest" and next_due is not None and next_due + offset <= fired_at:
+                # Há uma ocorrência mais recente também atrasada: só ela é enviada
+                self._coalesced += 1
+                scheduler_fires.inc("coalesced")
+                run = False
+        else:
+            # Fora da janela de tolerância (loop travado ou processo parado):
+            # o disparo é perdido e as ocorrências antigas são puladas
+            self._misfires += 1
+            scheduler_fires.inc("misfire")
+            print(f"Disparo perdido da tarefa {task_id}: atraso de {fired_at - due_ts:.0f}s")
+            next_due = next_fire_at(task["time"], fired_at - MISFIRE_GRACE_SECONDS, task.get("timezone"))
+        if next_due is not None:
+            self._push(task_id, next_due)
+        asyncio.ensure_future(asyncio.to_thread(
+            task_repo.record_fire, task_id, fired_at if run else None, next_due,
+            offset if run else None, fired_at - due_ts if run else None
+        ))
+        if not run:
+            return
+        self._record_lag(task_id, due_ts, fired_at, offset)
+        scheduler_fires.inc("sent")
+        if EXECUTION_MODE == "queue":
+            # Os workers (worker.py) executam o envio
+            asyncio.ensure_future(asyncio.to_thread(job_queue.enqueue, task_id, due_ts))
+        elif task.get("kind") == "broadcast":
+            asyncio.ensure_future(run_broadcast(task_id, task))
+        else:
+            asyncio.ensure_future(send_image_to_group(task["group_name"], task["image"], task["text"], task_id=task_id))
+
+    def _record_lag(self, task_id, due_ts, fired_at, offset=0.0):
+        lag = fired_at - (due_ts + offset)
+        scheduler_lag.observe(lag)
+        self._fires += 1
+        self._lag_total += lag
+        self._lag_max = max(self._lag_max, lag)
+        self._recent.append({
+            "task_id": task_id, "target": due_ts, "fired_at": fired_at, "lag_seconds": lag,
+            "planned_offset": offset, "actual_offset": fired_at - due_ts,
+        })
+
+    def metrics(self):
+        lags = sorted(item["lag_seconds"] for item in self._recent)
+
+        def percentile(p):
+            if not lags:
+                return None
+            return lags[min(len(lags) - 1, int(p * len(lags)))]
+
+        with self._lock:
+            scheduled = len(self._entries)
+            spreading = len(self._planned)
+        return {
+            "scheduled": scheduled,
+            "spreading": spreading,
+            "fires": self._fires,
+            "lag_avg_seconds": self._lag_total / self._fires if self._fires else None,
+            "lag_max_seconds": self._lag_max if self._fires else None,
+            "lag_p50_seconds": percentile(0.50),
+            "lag_p99_seconds": percentile(0.99),
+            "misfires": self._misfires,
+            "coalesced": self._coalesced,
+            "prestaged": self._prestaged,
+            "prestage_lead_seconds": PRESTAGE_LEAD_SECONDS,
+            "dispatch_spread_seconds": DISPATCH_SPREAD_SECONDS,
+            "misfire_grace_seconds": MISFIRE_GRACE_SECONDS,
+            "catch_up_policy": CATCH_UP_POLICY,
+            "recent_fires": list(self._recent)[-50:],
+        }
 
-async def schedule_task(task_id, task_details):
-    while tasks.get(task_id, {}).get("status") == "Rodando":
-        current_time = time.strftime("%H:%M")
-        if current_time == task_details["time"]:
-            await send_image_to_group(task_details["group_name"], task_details["image"], task_details["text"])
-            await asyncio.sleep(60)  # Espera 1 minuto antes de verificar novamente
-        await asyncio.sleep(1)
+scheduler = TaskScheduler()
 
 async def get_group_members(group_name):
     try:
-        for dialog in await client.get_dialogs():
-            if dialog.name == group_name:
-                participants = await client.get_participants(dialog)
-                return [{"id": user.id, "username": user.username, "first_name": user.first_name} for user in participants]
+        account, chat = await session_pool.pick(group_name, groups_only=False)
+        if chat is None:
+            return []
+        return await member_cache.get(account, chat)
     except Exception as e:
         print(f"Erro ao obter membros do grupo: {str(e)}")
         return []
@@ -178,30 +2470,21 @@ async def get_group_members(group_name):
 async def send_tag_message(group_name):
     try:
         # Encontrar o grupo
-        target_group = None
-        async for dialog in client.iter_dialogs():
-            if dialog.name == group_name:
-                target_group = dialog
-                break
-        
-        if not target_group:
+        account, target_group = await session_pool.pick(group_name, groups_only=False)
+        if target_group is None:
             return False, "Grupo não encontrado"
 
         # Obter participantes
-        participants = await client.get_participants(target_group)
+        participants = await member_cache.get(account, target_group)
         
-        # Criar mensagem de marcação
-        tag_message = ""
-        for user in participants:
-            if user.username:
-                tag_message += f"@{user.username} "
-            elif user.first_name:
-                tag_message += f"[{user.first_name}](tg://user?id={user.id}) "
-        
-        # Enviar mensagem
-        if tag_message:
-            await client.send_message(target_group, tag_message.strip())
-            return True, "Mensagem de marcação enviada com sucesso"
+        # Dividir a marcação em mensagens dentro dos limites e enfileirar o envio
+        chunks = 0
+        for text, mentions in build_mention_chunks(participants):
+            account.mentions.put(target_group, text, mention_entities(mentions))
+            chunks += 1
+
+        if chunks:
+            return True, f"Mensagem de marcação enfileirada ({chunks} mensagem(ns))"
         return False, "Nenhum membro para marcar"
         
     except Exception as e:
@@ -209,57 +2492,571 @@ async def send_tag_message(group_name):
 
 async def check_group_exists(group_name):
     try:
-        async for dialog in client.iter_dialogs():
-            if dialog.name == group_name:
-                return True
-        return False
+        return bool(await session_pool.candidates(group_name, groups_only=False))
     except Exception as e:
         print(f"Erro ao verificar grupo: {str(e)}")
         return False
 
 # Loop Assíncrono
 def start_asyncio_loop():
-    global asyncio_loop
-    asyncio_loop = asyncio.new_event_loop()
     asyncio.set_event_loop(asyncio_loop)
     asyncio_loop.run_forever()
 
-asyncio_thread = Thread(target=start_asyncio_loop, daemon=True)
-asyncio_thread.start()
+async def run_in_loop(coro):
+    # No modo ASGI a view já roda no loop do Telethon e aguarda direto; no modo
+    # WSGI o Flask executa a view async em outro loop e a corrotina é repassada
+    if asyncio.get_running_loop() is asyncio_loop:
+        return await coro
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, asyncio_loop))
 
 # Persistência do Estado
-def load_state():
+def clear_logins(phones):
+    with db_pool.transaction() as conn:
+        conn.executemany("DELETE FROM login WHERE phone = ?", [(phone,) for phone in phones])
+
+def restore_accounts():
     global client, authenticated, api_id, api_hash
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute("SELECT api_id, api_hash, phone, session FROM login ORDER BY id DESC LIMIT 1")
-    row = c.fetchone()
-    if row:
-        api_id, api_hash, phone, session_str = row
-        client = TelegramClient(StringSession(session_str), int(api_id), api_hash)
-        asyncio.run_coroutine_threadsafe(client.connect(), asyncio_loop)
+    # Restaura todas as contas (o login mais recente de cada telefone); a
+    # conexão fica para o lifecycle, em segundo plano
+    with db_pool.connection() as conn:
+        rows = conn.execute("""
+            SELECT api_id, api_hash, phone, session FROM login
+            WHERE id IN (SELECT MAX(id) FROM login GROUP BY phone)
+            ORDER BY id
+        """).fetchall()
+    for row_api_id, row_api_hash, phone, session_str in rows:
+        session_pool.add(Account(phone, create_client(StringSession(session_str), row_api_id, row_api_hash)))
+    if rows:
+        api_id, api_hash = rows[-1][0], rows[-1][1]
+        client = session_pool.get(rows[-1][2]).client
         authenticated = True
-    
-    c.execute("SELECT id, group_name, time, text, image, status, tag_members FROM tasks")
-    for row in c.fetchall():
-        task_id, group_name, time, text, image, status, tag_members = row
-        tasks[task_id] = {
-            "group_name": group_name,
-            "time": time,
-            "text": text,
-            "image": image,
-            "status": status,
-            "tag_members": bool(tag_members)
+
+def restore_schedule():
+    for task_id, task in task_repo.all():
+        if task["status"] == "Rodando":
+            scheduler.restore(task_id, task)
+
+# Ciclo de Vida
+api_lock = None
+
+def claim_api_process():
+    # O cache de tarefas e o heap do agendador vivem na memória do processo
+    # da API, então só um processo da API pode usar o banco; a escala vem dos
+    # workers (worker.py). A trava some junto com o processo.
+    global api_lock
+    if api_lock is not None or fcntl is None:
+        return
+    lock = open(db_file + ".api.lock", "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        raise RuntimeError(f"Outro processo da API já usa {db_file}; rode uma única instância da API")
+    api_lock = lock
+
+class Lifecycle:
+    # Inicialização explícita, fora da importação. start() prepara o banco, o
+    # cache de tarefas e as contas (leituras locais, rápidas) e devolve logo;
+    # a conexão com o Telegram, o agendamento e o aquecimento dos caches
+    # seguem em segundo plano, etapa por etapa, visíveis em /health/ready.
+    STAGES = ("database", "accounts", "scheduler", "caches")
+    REQUIRED = ("database", "accounts", "scheduler")  # os caches só aceleram
+
+    def __init__(self):
+        self.started_at = None
+        self.schedule_tasks = True
+        self._lock = Lock()
+        self._stages = {stage: {"status": "pendente", "error": None, "seconds": None} for stage in self.STAGES}
+        self._events = {stage: Event() for stage in self.STAGES}
+        self._serving = Event()  # banco preparado e loop no ar: as rotas já podem rodar
+
+    def start(self, loop=None, schedule=True):
+        # Idempotente: o __main__, o lifespan do ASGI e a primeira requisição
+        # (servidores WSGI que só importam o app) podem chamar. loop é o loop
+        # já em execução do servidor ASGI; sem ele, cria-se um numa thread.
+        # schedule=False (worker.py) só executa jobs, sem agendar tarefas;
+        # com schedule=True, um segundo processo da API falha no banco.
+        # Quem chega enquanto outro start ainda prepara o banco espera por ele;
+        # se o preparo falha, o próximo start tenta de novo.
+        global asyncio_loop
+        with self._lock:
+            first = self.started_at is None
+            if first:
+                self.started_at = time.time()
+        if not first:
+            self._serving.wait()
+            if self._stages["database"]["status"] != "pronto":
+                raise RuntimeError(f"Falha na inicialização: {self._stages['database']['error']}")
+            return
+        self.schedule_tasks = schedule
+        try:
+            self._run("database", self._prepare)
+        except Exception:
+            with self._lock:
+                self.started_at = None
+            # Libera quem esperava este start; os próximos recomeçam do zero
+            self._serving.set()
+            self._serving.clear()
+            self._events["database"].clear()
+            raise
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            asyncio_loop = loop
+            Thread(target=start_asyncio_loop, daemon=True).start()
+        else:
+            asyncio_loop = loop
+        if schedule:
+            scheduler.start(loop)
+        asyncio.run_coroutine_threadsafe(self._warm_up(), loop)
+        self._serving.set()
+
+    def _prepare(self):
+        if self.schedule_tasks:
+            claim_api_process()
+        os.makedirs(image_pipeline.directory, exist_ok=True)
+        init_db()
+        task_repo.load()
+        group_store.load()
+        restore_accounts()
+
+    def _finish(self, stage, started, error=None, warning=None):
+        # warning: a etapa terminou degradada, o que ainda conta como pronta
+        self._stages[stage].update(
+            status="falhou" if error else "degradado" if warning else "pronto",
+            error=str(error) if error else warning,
+            seconds=round(time.perf_counter() - started, 3),
+        )
+        self._events[stage].set()
+        if error:
+            print(f"Falha na inicialização ({stage}): {error}")
+
+    def _run(self, stage, func):
+        started = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            self._finish(stage, started, e)
+            raise
+        self._finish(stage, started)
+
+    async def _run_async(self, stage, coro, check=None):
+        # check roda depois da etapa: levanta se ela não teve efeito ou
+        # devolve um aviso para marcá-la como degradada
+        started = time.perf_counter()
+        try:
+            await coro
+            warning = check() if check else None
+        except Exception as e:
+            self._finish(stage, started, e)
+            return
+        self._finish(stage, started, warning=warning)
+
+    @staticmethod
+    def _check_accounts():
+        # Account.connect não levanta: sem nenhuma conta "ok" a etapa falha
+        accounts = session_pool.all()
+        down = [f"{account.phone}: {account.health}" for account in accounts if account.health != "ok"]
+        if down and len(down) == len(accounts):
+            raise RuntimeError(f"Nenhuma conta conectada ({'; '.join(down)})")
+        return f"Contas fora do ar ({'; '.join(down)})" if down else None
+
+    async def _warm_up(self):
+        accounts = session_pool.all()
+        # Os disparos atrasados só voltam ao heap com as contas já conectadas
+        await self._run_async(
+            "accounts", asyncio.gather(*(account.connect() for account in accounts)), check=self._check_accounts
+        )
+        await self._run_async("scheduler", asyncio.to_thread(restore_schedule) if self.schedule_tasks else asyncio.sleep(0))
+        await self._run_async("caches", asyncio.gather(
+            *(account.dialogs.refresh() for account in accounts if account.health == "ok"),
+            return_exceptions=True,
+        ))
+
+    def wait(self, stage, timeout=None):
+        return self._events[stage].wait(timeout)
+
+    def ready(self):
+        return all(self._stages[stage]["status"] in ("pronto", "degradado") for stage in self.REQUIRED)
+
+    def status(self):
+        return {
+            "ready": self.ready(),
+            "started_at": self.started_at,
+            "stages": {stage: dict(info) for stage, info in self._stages.items()},
+            "accounts": [
+                {"phone": account.phone, "health": account.status()["health"], "last_error": account.last_error}
+                for account in session_pool.all()
+            ],
         }
-        if status == "Rodando":
-            asyncio.run_coroutine_threadsafe(schedule_task(task_id, tasks[task_id]), asyncio_loop)
-    conn.close()
 
-load_state()
+lifecycle = Lifecycle()
+
+def create_app(start=True, schedule=True):
+    # Fábrica usada pelos servidores e scripts: as rotas ficam no app do
+    # módulo, e importar api.py não abre o banco nem conecta ao Telegram
+    if start:
+        lifecycle.start(schedule=schedule)
+    return app
+
+# Armazenamento de Mídia
+class MediaStore:
+    # Arquivos endereçados pelo SHA-256 do conteúdo: a mesma imagem é gravada
+    # uma única vez em disco e enviada ao Telegram uma única vez; a mídia
+    # devolvida no primeiro envio é reutilizada até a referência expirar.
+    REMOTE_TTL = 6 * 3600
+    UPLOAD_TTL = 3600  # o Telegram descarta as partes de um upload não usado
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._digests = {}  # {path: (mtime, size, digest)} para arquivos antigos
+        self._remote = {}  # {(phone, digest): (media, cached_at)}
+        self._uploads = {}  # {(phone, digest): (InputFile, uploaded_at)} pré-enviados
+        self._locks = {}
+
+    def path_for(self, digest, ext):
+        return os.path.join(self.directory, f"{digest}{ext.lower()}")
+
+    def temp_path(self):
+        return os.path.join(self.directory, f".{uuid.uuid4()}.part")
+
+    def adopt(self, temp_path, digest, ext):
+        # Move o arquivo temporário para o nome definitivo; se o conteúdo já
+        # existe, o temporário é descartado. Retorna (caminho, criado)
+        path = self.path_for(digest, ext)
+        if os.path.exists(path):
+            os.remove(temp_path)
+            return path, False
+        os.replace(temp_path, path)
+        return path, True
+
+    def store_bytes(self, data, ext):
+        upload_bytes.inc("base64", amount=len(data))
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path_for(digest, ext)
+        if not os.path.exists(path):
+            temp_path = self.temp_path()
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            path, _ = self.adopt(temp_path, digest, ext)
+        return path
+
+    def store_stream(self, stream, ext):
+        sha = hashlib.sha256()
+        temp_path = self.temp_path()
+        with open(temp_path, "wb") as f:
+            for chunk in iter(lambda: stream.read(self.CHUNK_SIZE), b""):
+                sha.update(chunk)
+                f.write(chunk)
+            upload_bytes.inc("stream", amount=f.tell())
+        path, _ = self.adopt(temp_path, sha.hexdigest(), ext)
+        return path
+
+    def digest_for(self, path):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if len(name) == 64 and all(ch in "0123456789abcdef" for ch in name):
+            return name
+        # Arquivos anteriores ao armazenamento por hash (nomes com UUID)
+        stat = os.stat(path)
+        cached = self._digests.get(path)
+        if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+            return cached[2]
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b""):
+                sha.update(chunk)
+        self._digests[path] = (stat.st_mtime, stat.st_size, sha.hexdigest())
+        return sha.hexdigest()
+
+    # A mídia devolvida pelo Telegram só vale para a conta que a enviou
+    def remote_media(self, phone, digest):
+        cached = self._remote.get((phone, digest))
+        if cached is None:
+            return None
+        media, cached_at = cached
+        if time.time() - cached_at > self.REMOTE_TTL:
+            del self._remote[(phone, digest)]
+            return None
+        return media
+
+    def remember(self, phone, digest, message):
+        media = getattr(message, "media", None)
+        if media is not None:
+            self._remote[(phone, digest)] = (media, time.time())
+
+    def forget_remote(self, phone=None, digest=None):
+        for cache in (self._remote, self._uploads):
+            for key in list(cache):
+                if (phone is None or key[0] == phone) and (digest is None or key[1] == digest):
+                    del cache[key]
+
+    def _take_upload(self, phone, digest):
+        upload = self._uploads.pop((phone, digest), None)
+        if upload is None:
+            return None
+        handle, uploaded_at = upload
+        if time.time() - uploaded_at > self.UPLOAD_TTL:
+            prestages.inc("expired")
+            return None
+        return handle
+
+    async def prestage(self, account, path):
+        # Faz o upload antes do prazo e guarda o handle: o primeiro envio vira
+        # um único send_file. Nada a fazer se a mídia já está no Telegram.
+        digest = self.digest_for(path)
+        lock = self._locks.setdefault((account.phone, digest), asyncio.Lock())
+        async with lock:
+            if self.remote_media(account.phone, digest) is not None:
+                return False
+            upload = self._uploads.get((account.phone, digest))
+            if upload and time.time() - upload[1] < self.UPLOAD_TTL:
+                return False
+            handle = await account.client.upload_file(await image_pipeline.photo_for(path))
+            self._uploads[(account.phone, digest)] = (handle, time.time())
+            return True
+
+    async def send(self, account, chat, path, caption=""):
+        with tracer.span("media_send", child=True, has_media=bool(path)):
+            return await self._send(account, chat, path, caption)
+
+    async def _send(self, account, chat, path, caption):
+        tg_client = account.client
+        if not path:
+            return await tg_client.send_message(chat, caption)
+        digest = self.digest_for(path)
+        media = self.remote_media(account.phone, digest)
+        cache_requests.inc("media", "miss" if media is None else "hit")
+        if media is not None:
+            try:
+                return await tg_client.send_file(chat, media, caption=caption)
+            except (FileReferenceExpiredError, FileReferenceInvalidError, MediaEmptyError):
+                self.forget_remote(account.phone, digest)
+
+        # Primeiro envio deste conteúdo: envios simultâneos esperam o upload
+        lock = self._locks.setdefault((account.phone, digest), asyncio.Lock())
+        async with lock:
+            media = self.remote_media(account.phone, digest)
+            if media is not None:
+                return await tg_client.send_file(chat, media, caption=caption)
+            handle = self._take_upload(account.phone, digest)
+            if handle is not None:
+                try:
+                    message = await tg_client.send_file(chat, handle, caption=caption)
+                    prestages.inc("used")
+                    self.remember(account.phone, digest, message)
+                    return message
+                except FilePartMissingError:
+                    prestages.inc("expired")
+            # O upload usa a foto recomprimida quando existe; o cache continua
+            # indexado pelo hash do original
+            message = await tg_client.send_file(chat, await image_pipeline.photo_for(path), caption=caption)
+            self.remember(account.phone, digest, message)
+            return message
+
+media_store = MediaStore(upload_dir)
+
+class ImagePipeline:
+    # Gera as variantes de cada imagem (foto recomprimida para o Telegram e
+    # miniatura para o painel) num pool de processos, uma vez por conteúdo:
+    # ficam em uploads/variants/<sha256>.<variante>.jpg
+    VARIANTS = ("photo", "thumb")
+
+    def __init__(self, store, directory, workers=IMAGE_WORKERS):
+        self.store = store
+        self.directory = directory
+        self.workers = workers
+        self._executor = None
+        self._pending = {}  # {digest: Future}
+        self._failed = set()  # conteúdos que o Pillow não abre: não voltam ao pool
+        self._lock = Lock()
+
+    def variant_path(self, digest, variant):
+        return os.path.join(self.directory, f"{digest}.{variant}.jpg")
+
+    def _pool(self):
+        if self._executor is None:
+            # spawn: o processo já tem a thread do loop e as do servidor, e um
+            # fork copiaria locks presos por elas. Cada worker reimporta o
+            # __main__ (api.py ou worker.py, sem o bloco do __main__) antes de
+            # imaging; importar api.py não abre o banco nem conecta ao Telegram.
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def submit(self, path):
+        # Agenda o pré-processamento; None se não há o que fazer
+        if imaging is None or self.workers < 1 or not path or not os.path.isfile(path):
+            return None
+        digest = self.store.digest_for(path)
+        if digest in self._failed or os.path.exists(self.variant_path(digest, "thumb")):
+            return None
+        with self._lock:
+            future = self._pending.get(digest)
+            created = future is None
+            if created:
+                future = self._pool().submit(
+                    imaging.prepare_variants, path,
+                    self.variant_path(digest, "photo"), self.variant_path(digest, "thumb")
+                )
+                self._pending[digest] = future
+        # Fora do lock: se o future já terminou, o callback roda aqui mesmo
+        if created:
+            future.add_done_callback(partial(self._finished, digest))
+        return future
+
+    def _finished(self, digest, future):
+        error = None if future.cancelled() else future.exception()
+        with self._lock:
+            self._pending.pop(digest, None)
+            if isinstance(error, BrokenProcessPool):
+                # Um worker morreu: o próximo submit cria outro pool
+                self._executor = None
+            elif error is not None:
+                self._failed.add(digest)
+        if error is not None:
+            print(f"Erro ao processar imagem {digest}: {error}")
+
+    def variant(self, path, variant, wait=0):
+        # Caminho da variante, esperando até "wait" segundos se ela ainda não existe
+        target = self.variant_path(self.store.digest_for(path), variant)
+        if os.path.exists(target):
+            cache_requests.inc("variants", "hit")
+            return target
+        cache_requests.inc("variants", "miss")
+        future = self.submit(path)
+        if future is not None and wait:
+            try:
+                future.result(timeout=wait)
+            except Exception:
+                pass
+        return target if os.path.exists(target) else None
+
+    async def photo_for(self, path):
+        # Usado no envio: espera o pré-processamento em andamento; sem Pillow
+        # (ou se a foto não compensou) segue o original
+        future = self.submit(path)
+        if future is not None:
+            try:
+                await asyncio.wrap_future(future)
+            except Exception:
+                pass
+        target = self.variant_path(self.store.digest_for(path), "photo")
+        return target if os.path.exists(target) else path
+
+image_pipeline = ImagePipeline(media_store, os.path.join(upload_dir, "variants"))
+
+# Uploads
+def detect_image_type(head):
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+class StreamingImageSink:
+    # Destino de um arquivo do multipart: os blocos vão direto para uploads/
+    # enquanto o corpo é lido, com tamanho e tipo verificados no caminho.
+    HEAD_SIZE = 12
+
+    def __init__(self, filename, ext):
+        self.path = media_store.temp_path()
+        self.filename = filename
+        self.ext = ext
+        self.size = 0
+        self.created = False
+        self._sha = hashlib.sha256()
+        self._head = b""
+        self._checked = False
+        self._file = open(self.path, "wb+")
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > MAX_IMAGE_BYTES:
+            raise ValueError(f"Imagem {self.filename} excede o limite de {MAX_IMAGE_BYTES // (1024 * 1024)} MB")
+        if not self._checked:
+            self._head += data[:self.HEAD_SIZE - len(self._head)]
+            if len(self._head) >= self.HEAD_SIZE:
+                self._check_type()
+        self._sha.update(data)
+        return self._file.write(data)
+
+    def _check_type(self):
+        self._checked = True
+        if detect_image_type(self._head) is None:
+            raise ValueError(f"Arquivo {self.filename} não é uma imagem válida")
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def finish(self):
+        if not self._checked:
+            self._check_type()
+        self._file.close()
+        upload_bytes.inc("multipart", amount=self.size)
+        self.path, self.created = media_store.adopt(self.path, self._sha.hexdigest(), self.ext)
+
+    def discard(self):
+        self._file.close()
+        if (self.created or self.path.endswith(".part")) and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        self._file.close()
+
+def resolve_stored_image(ref):
+    # Referência a um arquivo já enviado por /images ("uploads/<nome>" ou "<nome>")
+    path = os.path.join(upload_dir, os.path.basename(ref or ""))
+    if not os.path.basename(ref or "") or not os.path.isfile(path):
+        raise ValueError(f"Imagem não encontrada: {ref}")
+    return path
+
+def parse_streaming_tasks():
+    # multipart/form-data: campo "tasks" com o JSON das tarefas e uma parte de
+    # arquivo por imagem, referenciada na tarefa por "image_field"
+    sinks = []
+
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        ext = os.path.splitext(filename or "")[1].lower() or ".jpg"
+        if ext not in ALLOWED_IMAGE_EXTENSIONS:
+            raise ValueError(f"Tipo de arquivo não permitido: {filename}")
+        sink = StreamingImageSink(filename, ext)
+        sinks.append(sink)
+        return sink
+
+    parser = FormDataParser(stream_factory=stream_factory, max_form_memory_size=MAX_FORM_MEMORY, silent=False)
+    try:
+        _, form, files = parser.parse(request.stream, request.mimetype, request.content_length, request.mimetype_params)
+        for sink in sinks:
+            sink.finish()
+        try:
+            tasks_data = json.loads(form.get("tasks") or "")
+        except ValueError:
+            raise ValueError("Campo 'tasks' ausente ou com JSON inválido")
+        if not isinstance(tasks_data, list):
+            raise ValueError("Campo 'tasks' deve ser uma lista")
+        # um nome repetido deixaria as partes anteriores sem referência
+        duplicated = sorted(name for name, parts in files.lists() if len(parts) > 1)
+        if duplicated:
+            raise ValueError(f"Campo de arquivo repetido: {', '.join(duplicated)}")
+    except Exception:
+        for sink in sinks:
+            sink.discard()
+        raise
+    saved_files = {name: storage.stream for name, storage in files.items()}
+    return tasks_data, saved_files
 
 # Rotas da API
 @app.route("/auth/send_code", methods=["POST"])
-def auth_send_code():
+async def auth_send_code():
     global api_id, api_hash
     data = request.json
     api_id = data.get("api_id")
@@ -268,13 +3065,12 @@ def auth_send_code():
     if not api_id or not api_hash or not phone:
         return jsonify({"success": False, "message": "api_id, api_hash e phone são obrigatórios"}), 400
 
-    future = asyncio.run_coroutine_threadsafe(send_code_request(api_id, api_hash, phone), asyncio_loop)
-    success, msg = future.result()
+    success, msg = await run_in_loop(send_code_request(api_id, api_hash, phone))
     status = 200 if success else 400
     return jsonify({"success": success, "message": msg}), status
 
 @app.route("/auth/verify_code", methods=["POST"])
-def auth_verify_code():
+async def auth_verify_code():
     if not api_id or not api_hash:
         return jsonify({"success": False, "message": "Envie primeiro o código"}), 400
     data = request.json
@@ -283,21 +3079,77 @@ def auth_verify_code():
     if not phone or not code:
         return jsonify({"success": False, "message": "phone e code são obrigatórios"}), 400
 
-    future = asyncio.run_coroutine_threadsafe(do_authenticate(phone, code), asyncio_loop)
-    success, msg = future.result()
+    success, msg = await run_in_loop(do_authenticate(phone, code))
     status = 200 if success else 400
     if success:
-        future_groups = asyncio.run_coroutine_threadsafe(load_groups(), asyncio_loop)
-        gsuccess, gdata = future_groups.result()
-        if not gsuccess:
-            msg += f" | Aviso: {gdata}"
+        # Os grupos carregam em segundo plano; /groups acompanha o progresso
+        asyncio.run_coroutine_threadsafe(load_groups(session_pool.get(phone)), asyncio_loop)
+        msg += " | Carregando grupos em segundo plano"
     return jsonify({"success": success, "message": msg}), status
 
 @app.route("/groups", methods=["GET"])
 def get_groups():
     if not authenticated:
         return jsonify({"success": False, "message": "Não autenticado"}), 401
-    return jsonify({"success": True, "groups": groups_cache}), 200
+
+    groups = group_store.all()
+    response = {
+        "success": True,
+        "loading": groups_loading,
+        "loaded": len(groups),
+        "total": len(groups),
+    }
+    if groups_load_error:
+        response["message"] = groups_load_error
+
+    # Paginação: ?offset=&limit= permite ler a lista enquanto ela é carregada
+    offset = request.args.get("offset", type=int)
+    limit = request.args.get("limit", type=int)
+    if offset is None and limit is None:
+        response["groups"] = groups
+        return jsonify(response), 200
+
+    offset = max(offset or 0, 0)
+    limit = max(limit or 100, 1)
+    page = groups[offset:offset + limit]
+    end = offset + len(page)
+    response["groups"] = page
+    response["next_offset"] = end if end < len(groups) or groups_loading else None
+    return jsonify(response), 200
+
+@app.route("/groups/refresh", methods=["POST"])
+def refresh_groups():
+    # Recarrega diálogos e grupos de todas as contas, para mudanças que não
+    # geraram evento (ex.: um grupo criado com a API fora do ar). Os índices
+    # são invalidados na hora; as listas, recarregadas uma conta por vez.
+    if not authenticated:
+        return jsonify({"success": False, "message": "Não autenticado"}), 401
+    accounts = session_pool.all()
+    for account in accounts:
+        account.dialogs.invalidate()
+
+    async def reload():
+        for account in accounts:
+            await load_groups(account)
+
+    asyncio.run_coroutine_threadsafe(reload(), asyncio_loop)
+    return jsonify({"success": True, "message": "Recarregando grupos", "accounts": len(accounts)}), 202
+
+@app.route("/groups/<int(signed=True):chat_id>/invite_link", methods=["GET"])
+async def group_invite_link(chat_id):
+    if not authenticated:
+        return jsonify({"success": False, "message": "Não autenticado"}), 401
+
+    # Buscado no Telegram só na primeira vez (ou depois de um evento do chat)
+    group = group_store.find(chat_id, request.args.get("account"))
+    account = session_pool.get(group["account"]) if group else None
+    if account is None:
+        return jsonify({"success": False, "message": "Grupo não encontrado"}), 404
+    try:
+        link = await run_in_loop(group_store.invite_link(account, chat_id))
+    except Exception as e:
+        return jsonify({"success": False, "message": f"Erro ao buscar o link de convite: {e}"}), 502
+    return jsonify({"success": True, "id": chat_id, "account": account.phone, "link": link}), 200
 
 @app.route("/images", methods=["POST"])
 def upload_images():
@@ -311,7 +3163,6 @@ def upload_images():
     files = request.files.getlist("images")
     texts = request.form.get("texts")
     if texts:
-        import json
         try:
             texts = json.loads(texts)
         except:
@@ -322,9 +3173,9 @@ def upload_images():
 
     uploaded_data = []
     for i, f in enumerate(files):
-        filename = f"{uuid.uuid4()}_{f.filename}"
-        filepath = os.path.join(upload_dir, filename)
-        f.save(filepath)
+        ext = os.path.splitext(f.filename or "")[1] or ".jpg"
+        filepath = media_store.store_stream(f.stream, ext)
+        image_pipeline.submit(filepath)
         text = texts[i] if texts and i < len(texts) else ""
         uploaded_data.append({"path": filepath, "text": text})
 
@@ -335,90 +3186,123 @@ async def tag_members(group_name):
     if not authenticated:
         return jsonify({"error": "Not authenticated"}), 401
 
-    members = await get_group_members(group_name)
-    tag_text = ""
-    for member in members:
-        if member["username"]:
-            tag_text += f"@{member['username']} "
-        elif member["first_name"]:
-            tag_text += f"[{member['first_name']}](tg://user?id={member['id']}) "
+    members = await run_in_loop(get_group_members(group_name))
+    raw_chunks = list(build_mention_chunks(members))
+    chunks = [mention_chunk_json(text, mentions) for text, mentions in raw_chunks]
+    tag_text = " ".join(mention_markdown(member) for _, mentions in raw_chunks for _, _, member in mentions)
 
-    return jsonify({"tag_text": tag_text.strip()})
+    return jsonify({"tag_text": tag_text, "chunks": chunks})
 
 @app.route("/tag_members_individual/<group_name>", methods=["GET"])
 async def tag_members_individual(group_name):
     if not authenticated:
         return jsonify({"error": "Not authenticated"}), 401
 
-    members = await get_group_members(group_name)
-    individual_tags = []
-    for member in members:
-        if member["username"]:
-            individual_tags.append(f"@{member['username']}")
-        elif member["first_name"]:
-            individual_tags.append(f"[{member['first_name']}](tg://user?id={member['id']})")
-
-    return jsonify({"individual_tags": individual_tags})
+    members = await run_in_loop(get_group_members(group_name))
+    # Uma menção por bloco: cada marcação individual vira sua própria mensagem
+    raw_chunks = list(build_mention_chunks(members, max_mentions=1))
+    chunks = [mention_chunk_json(text, mentions) for text, mentions in raw_chunks]
+    individual_tags = [mention_markdown(mentions[0][2]) for _, mentions in raw_chunks]
+
+    return jsonify({"individual_tags": individual_tags, "chunks": chunks})
+
+def task_image_path(task_id, task, saved_files):
+    if task.get('image_field'):
+        if task['image_field'] not in saved_files:
+            raise ValueError(f"Imagem '{task['image_field']}' não enviada")
+        return saved_files[task['image_field']].path
+    if task.get('image_path'):
+        return resolve_stored_image(task['image_path'])
+
+    # Processar imagem em base64 se existir
+    image_path = None
+    if 'image' in task and task['image'].strip():
+        try:
+            image_data = task['image'].split(',')[1]
+            image_bytes = base64.b64decode(image_data)
+            ext = os.path.splitext(task.get('filename', '.jpg'))[1] or '.jpg'
+            image_path = media_store.store_bytes(image_bytes, ext)
+        except Exception as e:
+            print(f"Erro ao processar imagem: {str(e)}")
+            image_path = None
+    return image_path
 
 @app.route("/add_tasks", methods=["POST"])
 def add_new_tasks():
     if not authenticated:
         return jsonify({"error": "Not authenticated"}), 401
 
-    if 'tasks' not in request.json:
-        return jsonify({"error": "No tasks provided"}), 400
+    # Além do JSON com imagens em base64, aceita multipart/form-data com as
+    # imagens gravadas em disco durante a leitura do corpo
+    saved_files = {}
+    if request.mimetype == "multipart/form-data":
+        try:
+            tasks_data, saved_files = parse_streaming_tasks()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    else:
+        if not request.json or 'tasks' not in request.json:
+            return jsonify({"error": "No tasks provided"}), 400
+        tasks_data = request.json['tasks']
+
+    new_tasks = []
+    used_files = set()
+    try:
+        for task in tasks_data:
+            if not isinstance(task, dict):
+                continue
+            # "group_names" (lista) cria um envio em massa para vários grupos
+            group_names = task.get('group_names')
+            if group_names is not None:
+                group_names = unique_group_names(group_names)
+            if ('group_name' not in task and not group_names) or 'time' not in task:
+                continue
+            time_spec = validate_schedule(task['time'], task.get('timezone'))
+            validate_dispatch(task.get('spread_seconds'), task.get('priority', 0))
+            task_id = str(uuid.uuid4())
+            image_path = task_image_path(task_id, task, saved_files)
+            used_files.add(image_path)
+            task_details = {
+                "group_name": task.get('group_name'),
+                "time": time_spec,
+                "text": task.get('text', ''),
+                "image": image_path,
+                "status": "Rodando",
+                "tag_members": task.get('tag_members', False),
+                "kind": "single",
+                "timezone": task.get('timezone'),
+                "spread_seconds": task.get('spread_seconds'),
+                "priority": task.get('priority', 0),
+                "next_fire_at": next_fire_at(time_spec, timezone=task.get('timezone'))
+            }
+            if group_names:
+                task_details.update(kind="broadcast", group_name=None, group_names=group_names)
+            new_tasks.append((task_id, task_details))
+    except ValueError as e:
+        used_files.clear()
+        return jsonify({"error": str(e)}), 400
+    finally:
+        # Arquivos criados por este envio mas não referenciados por nenhuma tarefa
+        for sink in saved_files.values():
+            if sink.path not in used_files:
+                sink.discard()
+
+    # Salvar no banco de dados (um único commit para o lote inteiro)
+    task_repo.add_many(new_tasks)
+    scheduler.push_many({
+        task_id: task_details["next_fire_at"] for task_id, task_details in new_tasks
+        if task_details["next_fire_at"] is not None
+    })
+    for image_path in used_files:
+        image_pipeline.submit(image_path)
 
-    tasks_data = request.json['tasks']
     response_tasks = []
-
-    for task in tasks_data:
-        if 'group_name' not in task or 'time' not in task:
-            continue
-
-        task_id = str(uuid.uuid4())
-        
-        # Processar imagem se existir
-        image_path = None
-        if 'image' in task and task['image'].strip():
-            try:
-                image_data = task['image'].split(',')[1]
-                image_bytes = base64.b64decode(image_data)
-                filename = f"{task_id}{os.path.splitext(task.get('filename', '.jpg'))[1]}"
-                image_path = os.path.join(upload_dir, filename)
-                
-                with open(image_path, 'wb') as f:
-                    f.write(image_bytes)
-            except Exception as e:
-                print(f"Erro ao processar imagem: {str(e)}")
-
-        task_details = {
-            "group_name": task['group_name'],
-            "time": task['time'],
-            "text": task.get('text', ''),
-            "image": image_path,
-            "status": "Rodando",
-            "tag_members": task.get('tag_members', False)
-        }
-
-        tasks[task_id] = task_details
-        
-        # Salvar no banco de dados
-        conn = sqlite3.connect(db_file)
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO tasks (id, group_name, time, text, image, status, tag_members)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (task_id, task_details["group_name"], task_details["time"], 
-              task_details["text"], task_details.get("image", ""), task_details["status"],
-              1 if task_details["tag_members"] else 0))
-        conn.commit()
-        conn.close()
-
+    for task_id, task_details in new_tasks:
         # Se tag_members for True, agendar o envio da mensagem de marcação
         if task_details["tag_members"]:
-            asyncio.run_coroutine_threadsafe(send_tag_message(task_details["group_name"]), asyncio_loop)
+            for group_name in task_group_names(task_details):
+                asyncio.run_coroutine_threadsafe(send_tag_message(group_name), asyncio_loop)
 
-        asyncio.run_coroutine_threadsafe(schedule_task(task_id, task_details), asyncio_loop)
         response_tasks.append({"task_id": task_id, **task_details})
 
     return jsonify({"message": "Tasks added successfully", "tasks": response_tasks})
@@ -428,43 +3312,232 @@ def list_tasks():
     if not authenticated:
         return jsonify({"success": False, "message": "Não autenticado"}), 401
 
+    # Filtros: ?status=Rodando,Parada&group=&kind=&time_from=HH:MM&time_to=HH:MM
+    # (só tarefas diárias "HH:MM"; para cron use fire_from/fire_to, timestamp ou
+    # data ISO do próximo disparo). Ordem: próximo disparo.
+    # Paginação: ?offset=&limit= (sem eles, a lista inteira, como antes)
+    status = [value for value in request.args.get("status", "").split(",") if value]
+    try:
+        fire_from, fire_to = timestamp_arg("fire_from"), timestamp_arg("fire_to")
+    except ValueError as e:
+        return jsonify({"success": False, "message": f"Data inválida: {e}"}), 400
+    offset = request.args.get("offset", type=int)
+    limit = request.args.get("limit", type=int)
+    paginated = offset is not None or limit is not None
+    offset = max(offset or 0, 0)
+    limit = max(limit or 100, 1) if paginated else None
+    total, tasks = task_repo.query(
+        status=status,
+        group=request.args.get("group"),
+        kind=request.args.get("kind"),
+        time_from=normalize_time(request.args.get("time_from")),
+        time_to=normalize_time(request.args.get("time_to")),
+        fire_from=fire_from,
+        fire_to=fire_to,
+        offset=offset,
+        limit=limit,
+    )
+
+    progress = task_repo.target_progress([tid for tid, tdata in tasks if tdata["kind"] == "broadcast"])
     tasks_list = []
-    for tid, tdata in tasks.items():
+    for tid, tdata in tasks:
+        if tdata.get("kind") == "broadcast":
+            tdata["progress"] = progress.get(tid, {"total": 0, "pending": 0, "sent": 0, "failed": 0})
         tasks_list.append({"task_id": tid, **tdata})
-    return jsonify({"success": True, "tasks": tasks_list}), 200
+    response = {"success": True, "tasks": tasks_list, "total": total}
+    if paginated:
+        end = offset + len(tasks_list)
+        response["next_offset"] = end if end < total else None
+    return jsonify(response), 200
+
+def bulk_task_ids():
+    data = request.get_json(silent=True) or {}
+    task_ids = data.get("task_ids")
+    if not isinstance(task_ids, list) or not task_ids:
+        return None, data
+    return [str(task_id) for task_id in task_ids], data
+
+def bulk_response(message, task_ids, done):
+    done = set(done)
+    return jsonify({
+        "success": True,
+        "message": message,
+        "updated": [task_id for task_id in task_ids if task_id in done],
+        "not_found": [task_id for task_id in task_ids if task_id not in done],
+    }), 200
+
+@app.route("/tasks/bulk/stop", methods=["POST"])
+def bulk_stop_tasks():
+    if not authenticated:
+        return jsonify({"success": False, "message": "Não autenticado"}), 401
+    task_ids, _ = bulk_task_ids()
+    if task_ids is None:
+        return jsonify({"success": False, "message": "task_ids deve ser uma lista não vazia"}), 400
+
+    updated = task_repo.update_many(task_ids, {"status": "Parada"}, next_fire=dict.fromkeys(task_ids))
+    scheduler.cancel_many([task_id for task_id, _ in updated])
+    return bulk_response("Tarefas paradas", task_ids, [task_id for task_id, _ in updated])
+
+@app.route("/tasks/bulk/resume", methods=["POST"])
+def bulk_resume_tasks():
+    if not authenticated:
+        return jsonify({"success": False, "message": "Não autenticado"}), 401
+    task_ids, _ = bulk_task_ids()
+    if task_ids is None:
+        return jsonify({"success": False, "message": "task_ids deve ser uma lista não vazia"}), 400
+
+    dues = {}
+    for task_id in task_ids:
+        task = task_repo.get(task_id)
+        if task is not None:
+            dues[task_id] = next_fire_at(task["time"], timezone=task.get("timezone"))
+    updated = task_repo.update_many(task_ids, {"status": "Rodando"}, next_fire=dues)
+    scheduler.push_many({task_id: dues[task_id] for task_id, _ in updated if dues.get(task_id) is not None})
+    return bulk_response("Tarefas retomadas", task_ids, [task_id for task_id, _ in updated])
+
+@app.route("/tasks/bulk/delete", methods=["POST"])
+def bulk_delete_tasks():
+    if not authenticated:
+        return jsonify({"success": False, "message": "Não autenticado"}), 401
+    task_ids, _ = bulk_task_ids()
+    if task_ids is None:
+        return jsonify({"success": False, "message": "task_ids deve ser uma lista não vazia"}), 400
+
+    deleted = task_repo.delete_many(task_ids)
+    scheduler.cancel_many(deleted)
+    return bulk_response("Tarefas deletadas", task_ids, deleted)
+
+@app.route("/tasks/bulk/edit", methods=["POST"])
+def bulk_edit_tasks():
+    if not authenticated:
+        return jsonify({"success": False, "message": "Não autenticado"}), 401
+    task_ids, data = bulk_task_ids()
+    if task_ids is None:
+        return jsonify({"success": False, "message": "task_ids deve ser uma lista não vazia"}), 400
+
+    # Grupos não entram na edição em massa: exigem a verificação de cada grupo (/edit_task)
+    changes = {field: value for field, value in (data.get("changes") or {}).items()
+               if field in ("time", "timezone", "text", "tag_members", "spread_seconds", "priority")}
+    if not changes:
+        return jsonify({
+            "success": False,
+            "message": "Nenhuma alteração válida (time, timezone, text, tag_members, spread_seconds, priority)"
+        }), 400
+    try:
+        validate_dispatch(changes.get("spread_seconds"), changes.get("priority", 0))
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+
+    dues = {}
+    if "time" in changes:
+        changes["time"] = normalize_time(changes["time"])
+    if "time" in changes or "timezone" in changes:
+        for task_id in task_ids:
+            task = task_repo.get(task_id)
+            if task is None:
+                continue
+            task.update(changes)
+            try:
+                validate_schedule(task["time"], task.get("timezone"))
+            except ValueError as e:
+                return jsonify({"success": False, "message": str(e)}), 400
+            if task["status"] == "Rodando":
+                dues[task_id] = next_fire_at(task["time"], timezone=task.get("timezone"))
+    updated = task_repo.update_many(task_ids, changes, next_fire=dues)
+    scheduler.push_many({task_id: dues[task_id] for task_id, _ in updated if dues.get(task_id) is not None})
+    return bulk_response("Tarefas atualizadas", task_ids, [task_id for task_id, _ in updated])
+
+def timestamp_arg(name):
+    # Aceita timestamp Unix ou data ISO ("2024-05-01" / "2024-05-01T10:00")
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+@app.route("/deliveries", methods=["GET"])
+def list_deliveries():
+    if not authenticated:
+        return jsonify({"success": False, "message": "Não autenticado"}), 401
+
+    # Filtros: ?task_id=&group=&status=sent|failed&since=&until=; paginação ?offset=&limit=
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", 100, type=int), 1), 1000)
+    try:
+        since, until = timestamp_arg("since"), timestamp_arg("until")
+    except ValueError as e:
+        return jsonify({"success": False, "message": f"Data inválida: {e}"}), 400
+    total, deliveries = delivery_log.history(
+        offset=offset, limit=limit, task_id=request.args.get("task_id"), group=request.args.get("group"),
+        status=request.args.get("status"), since=since, until=until,
+    )
+    end = offset + len(deliveries)
+    return jsonify({
+        "success": True, "deliveries": deliveries, "total": total, "next_offset": end if end < total else None
+    }), 200
+
+@app.route("/deliveries/stats", methods=["GET"])
+def delivery_stats():
+    if not authenticated:
+        return jsonify({"success": False, "message": "Não autenticado"}), 401
+
+    # ?by=task|group, com os mesmos filtros de /deliveries (exceto status)
+    by = request.args.get("by", "task")
+    if by not in ("task", "group"):
+        return jsonify({"success": False, "message": "by deve ser 'task' ou 'group'"}), 400
+    try:
+        since, until = timestamp_arg("since"), timestamp_arg("until")
+    except ValueError as e:
+        return jsonify({"success": False, "message": f"Data inválida: {e}"}), 400
+    stats = delivery_log.stats(
+        by=by, task_id=request.args.get("task_id"), group=request.args.get("group"), since=since, until=until
+    )
+    return jsonify({"success": True, "by": by, "stats": stats}), 200
 
 @app.route("/logout", methods=["POST"])
-def logout():
+async def logout():
     global client, authenticated, api_id, api_hash
     
     if not authenticated:
         return jsonify({"error": "Not authenticated"}), 401
 
+    # Com "phone" no corpo só essa conta sai; sem ele, todas
+    phone = (request.get_json(silent=True) or {}).get("phone")
+    if phone and not session_pool.get(phone):
+        return jsonify({"error": "Conta não encontrada"}), 404
+    accounts = [session_pool.get(phone)] if phone else session_pool.all()
+
     try:
-        # Desconectar cliente do Telegram
-        async def disconnect_client():
-            try:
-                if client:
-                    await client.log_out()
-                    await client.disconnect()
-            except Exception as e:
-                print(f"Erro ao desconectar cliente: {str(e)}")
+        # Desconectar clientes do Telegram
+        async def disconnect_clients():
+            for account in accounts:
+                try:
+                    await account.client.log_out()
+                    await account.client.disconnect()
+                except Exception as e:
+                    print(f"Erro ao desconectar cliente: {str(e)}")
 
         # Executar desconexão de forma assíncrona
-        asyncio.run_coroutine_threadsafe(disconnect_client(), asyncio_loop).result()
+        await run_in_loop(disconnect_clients())
 
         # Limpar dados do banco
-        conn = sqlite3.connect(db_file)
-        c = conn.cursor()
-        c.execute("DELETE FROM login")
-        conn.commit()
-        conn.close()
-
-        # Resetar variáveis globais
-        authenticated = False
-        api_id = None
-        api_hash = None
-        client = None
+        phones = [account.phone for account in accounts]
+        await asyncio.to_thread(clear_logins, phones)
+
+        # Resetar caches e variáveis globais
+        for account in accounts:
+            session_pool.remove(account.phone)
+            account.dialogs.clear()
+            media_store.forget_remote(account.phone)
+            member_cache.clear(account.phone)
+        await asyncio.to_thread(group_store.clear, phones)
+        authenticated = len(session_pool) > 0
+        if not authenticated:
+            api_id = None
+            api_hash = None
+            client = None
 
         return jsonify({"message": "Logout realizado com sucesso"}), 200
 
@@ -476,15 +3549,11 @@ def stop_a_task(task_id):
     if not authenticated:
         return jsonify({"success": False, "message": "Não autenticado"}), 401
 
-    if task_id not in tasks:
+    if task_repo.update(task_id, status="Parada") is None:
         return jsonify({"success": False, "message": "Tarefa não encontrada"}), 404
 
-    tasks[task_id]["status"] = "Parada"
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute("UPDATE tasks SET status = ? WHERE id = ?", ("Parada", task_id))
-    conn.commit()
-    conn.close()
+    scheduler.cancel(task_id)
+    task_repo.record_fire(task_id, next_fire_at=None)
 
     return jsonify({"success": True, "message": "Tarefa parada"}), 200
 
@@ -493,17 +3562,11 @@ def resume_a_task(task_id):
     if not authenticated:
         return jsonify({"success": False, "message": "Não autenticado"}), 401
 
-    if task_id not in tasks:
+    task = task_repo.update(task_id, status="Rodando")
+    if task is None:
         return jsonify({"success": False, "message": "Tarefa não encontrada"}), 404
 
-    tasks[task_id]["status"] = "Rodando"
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute("UPDATE tasks SET status = ? WHERE id = ?", ("Rodando", task_id))
-    conn.commit()
-    conn.close()
-
-    asyncio.run_coroutine_threadsafe(schedule_task(task_id, tasks[task_id]), asyncio_loop)
+    scheduler.schedule(task_id, task)
     return jsonify({"success": True, "message": "Tarefa retomada"}), 200
 
 @app.route("/tasks/<task_id>", methods=["DELETE"])
@@ -511,96 +3574,329 @@ def delete_a_task(task_id):
     if not authenticated:
         return jsonify({"success": False, "message": "Não autenticado"}), 401
 
-    if task_id not in tasks:
+    if not task_repo.delete(task_id):
         return jsonify({"success": False, "message": "Tarefa não encontrada"}), 404
 
-    del tasks[task_id]
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
-    conn.commit()
-    conn.close()
+    scheduler.cancel(task_id)
 
     return jsonify({"success": True, "message": "Tarefa deletada"}), 200
 
+@app.route("/accounts", methods=["GET"])
+def list_accounts():
+    if not authenticated:
+        return jsonify({"success": False, "message": "Não autenticado"}), 401
+    return jsonify({"success": True, "accounts": [account.status() for account in session_pool.all()]}), 200
+
+@app.route("/scheduler/metrics", methods=["GET"])
+def scheduler_metrics():
+    if not authenticated:
+        return jsonify({"success": False, "message": "Não autenticado"}), 401
+    metrics = scheduler.metrics()
+    if EXECUTION_MODE == "queue":
+        metrics["jobs"] = job_queue.stats()
+    return jsonify({"success": True, "metrics": metrics}), 200
+
+@app.before_request
+def start_request_timer():
+    request.environ["metrics.start"] = time.perf_counter()
+    # Servidores WSGI que só importam o app (gunicorn api:app) sobem tudo na
+    # primeira requisição, e as requisições simultâneas esperam o preparo; nos
+    # demais casos o start já foi chamado e isso só confere um Event
+    lifecycle.start()
+
+@app.after_request
+def record_request_metrics(response):
+    start = request.environ.get("metrics.start")
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else "desconhecida"
+        http_requests.inc(request.method, route, response.status_code)
+        http_latency.observe(time.perf_counter() - start, request.method, route)
+    return response
+
+# Filas e contas, lidas na hora da coleta
+metrics.gauge("scheduler_scheduled_tasks", "Tarefas com disparo agendado", (),
+              lambda: [((), scheduler.metrics()["scheduled"])])
+metrics.gauge("account_send_queue_depth", "Envios na fila (ou em andamento) de cada conta", ("account",),
+              lambda: [((account.phone,), account.pending()) for account in session_pool.all()])
+metrics.gauge("account_mention_queue_depth", "Mensagens de marcação na fila de cada conta", ("account",),
+              lambda: [((account.phone,), account.mentions.pending()) for account in session_pool.all()])
+metrics.gauge("account_flood_wait_seconds", "Segundos restantes de FloodWait de cada conta", ("account",),
+              lambda: [((account.phone,), max(0, account.flood_deadline() - time.time())) for account in session_pool.all()])
+metrics.gauge("account_rpc_rate", "Taxa atual (adaptativa) de requisições por segundo de cada conta", ("account",),
+              lambda: [((account.phone,), account.client.limiter.global_bucket.rate)
+                       for account in session_pool.all() if hasattr(account.client, "limiter")])
+metrics.gauge("delivery_log_pending", "Entregas aguardando gravação no log", (),
+              lambda: [((), delivery_log.pending())])
+metrics.gauge("job_queue_depth", "Jobs na fila durável por status", ("status",),
+              lambda: [((status,), count) for status, count in job_queue.stats().items()] if EXECUTION_MODE == "queue" else [])
+
+@app.route("/health/live", methods=["GET"])
+def health_live():
+    return jsonify({"alive": True}), 200
+
+@app.route("/health/ready", methods=["GET"])
+def health_ready():
+    # 503 até o banco, as contas e o agendador estarem prontos (ou só
+    # degradados: alguma conta fora, mas não todas); o estado de cada etapa e
+    # de cada conta vem junto para diagnosticar a inicialização
+    status = lifecycle.status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    # Aberto como os scrapers do Prometheus esperam; não expõe dados das tarefas
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/uploads/<path:filename>", methods=["GET"])
 def serve_uploaded_file(filename):
+    # ?variant=thumb (miniatura do painel) ou ?variant=photo (versão enviada ao Telegram)
+    variant = request.args.get("variant")
+    if variant is not None:
+        if variant not in ImagePipeline.VARIANTS:
+            return jsonify({"error": f"Variante inválida: {variant}"}), 400
+        source = os.path.join(upload_dir, os.path.basename(filename))
+        if os.path.isfile(source):
+            target = image_pipeline.variant(source, variant, wait=VARIANT_WAIT)
+            if target:
+                # Conteúdo endereçado por hash: pode ficar em cache indefinidamente
+                return send_from_directory(image_pipeline.directory, os.path.basename(target), max_age=31536000)
     return send_from_directory(upload_dir, filename)
 
 @app.route("/edit_task/<task_id>", methods=["PUT"])
-def edit_task(task_id):
+async def edit_task(task_id):
     if not authenticated:
         return jsonify({"error": "Not authenticated"}), 401
 
-    if task_id not in tasks:
+    old_task = task_repo.get(task_id)  # Guardar estado anterior para comparação
+    if old_task is None:
         return jsonify({"error": "Task not found"}), 404
 
     data = request.json
-    if not data:
+    if not data or not isinstance(data, dict):
         return jsonify({"error": "No data provided"}), 400
 
-    task = tasks[task_id]
-    old_task = task.copy()  # Guardar estado anterior para comparação
+    task = old_task
+
+    # Se estiver mudando o grupo (ou os grupos de um envio em massa), verificar se existem
+    new_groups = []
+    if task.get("kind") == "broadcast":
+        if "group_names" in data:
+            try:
+                data["group_names"] = unique_group_names(data["group_names"] or [])
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            if not data["group_names"]:
+                return jsonify({"error": "group_names não pode ser vazio"}), 400
+            new_groups = [g for g in data["group_names"] if g not in task.get("group_names", [])]
+    elif "group_name" in data and data["group_name"] != task["group_name"]:
+        new_groups = [data["group_name"]]
+
+    for group_name in new_groups:
+        group_exists = await run_in_loop(check_group_exists(group_name))
 
-    # Se estiver mudando o grupo, verificar se existe
-    if "group_name" in data and data["group_name"] != task["group_name"]:
-        group_exists = asyncio.run_coroutine_threadsafe(
-            check_group_exists(data["group_name"]), 
-            asyncio_loop
-        ).result()
-        
         if not group_exists:
             return jsonify({
-                "error": f"Grupo '{data['group_name']}' não encontrado. Verifique se o bot está adicionado ao grupo."
+                "error": f"Grupo '{group_name}' não encontrado. Verifique se o bot está adicionado ao grupo."
             }), 400
 
-    # Atualizar os campos fornecidos
-    if "group_name" in data:
-        task["group_name"] = data["group_name"]
-    if "time" in data:
-        task["time"] = data["time"]
-    if "text" in data:
-        task["text"] = data["text"]
-    if "tag_members" in data:
-        task["tag_members"] = data["tag_members"]
-
-    # Atualizar no banco de dados
-    conn = sqlite3.connect(db_file)
-    c = conn.cursor()
-    c.execute("""
-        UPDATE tasks 
-        SET group_name = ?, time = ?, text = ?, status = ?, tag_members = ?
-        WHERE id = ?
-    """, (task["group_name"], task["time"], task["text"], task["status"], 
-          1 if task.get("tag_members", False) else 0, task_id))
-    conn.commit()
-    conn.close()
-
-    # Reagendar a task se necessário
-    needs_reschedule = (
-        ("group_name" in data and data["group_name"] != old_task["group_name"]) or
-        ("time" in data and data["time"] != old_task["time"])
+    if "time" in data or "timezone" in data:
+        try:
+            time_spec = validate_schedule(data.get("time", task["time"]), data.get("timezone", task.get("timezone")))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if "time" in data:
+            data["time"] = time_spec
+
+    if "spread_seconds" in data or "priority" in data:
+        try:
+            validate_dispatch(data.get("spread_seconds"), data.get("priority", 0))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+    # Atualizar os campos fornecidos (banco e cache)
+    editable = (
+        "group_names" if task.get("kind") == "broadcast" else "group_name",
+        "time", "timezone", "text", "tag_members", "spread_seconds", "priority",
     )
+    changes = {field: data[field] for field in editable if field in data}
+    task = await asyncio.to_thread(task_repo.update, task_id, **changes)
+    if task is None:
+        return jsonify({"error": "Task not found"}), 404
 
-    if needs_reschedule:
-        # Cancelar tarefa antiga
-        if task_id in tasks:
-            tasks[task_id]["status"] = "Parado"
-        # Criar nova tarefa
-        asyncio.run_coroutine_threadsafe(schedule_task(task_id, task), asyncio_loop)
+    # Reagendar a task se o horário ou o fuso mudou (o grupo é lido no momento do disparo)
+    rescheduled = task["time"] != old_task["time"] or task.get("timezone") != old_task.get("timezone")
+    if rescheduled and task["status"] == "Rodando":
+        task["next_fire_at"] = await asyncio.to_thread(scheduler.schedule, task_id, task)
 
     return jsonify({"message": "Task updated successfully", "task": task})
 
 @app.route("/send_tag_message/<group_name>", methods=["POST"])
-def tag_message_endpoint(group_name):
+async def tag_message_endpoint(group_name):
     if not authenticated:
         return jsonify({"error": "Not authenticated"}), 401
 
-    success, message = asyncio.run(send_tag_message(group_name))
+    success, message = await run_in_loop(send_tag_message(group_name))
     
     if success:
         return jsonify({"message": message}), 200
     return jsonify({"error": message}), 400
 
+# Servidor ASGI
+class FlaskASGI:
+    # Serve o app Flask como aplicação ASGI. As views async são aguardadas
+    # direto no loop em que o servidor roda; as síncronas vão para o executor
+    # com o contexto da requisição copiado.
+    BODY_SPOOL = 1024 * 1024
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        # Corpos grandes (uploads) vão para disco em vez de ficar em memória
+        body = tempfile.SpooledTemporaryFile(max_size=self.BODY_SPOOL)
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    return
+                body.write(message.get("body", b""))
+                if not message.get("more_body"):
+                    break
+            size = body.tell()
+            body.seek(0)
+            environ = self._environ(scope, body, size)
+            response = await self._dispatch(environ)
+            await self._send_response(environ, response, send)
+        finally:
+            body.close()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # uvicorn api:asgi_app: o loop do servidor passa a ser o do Telethon
+                try:
+                    lifecycle.start(loop=asyncio.get_running_loop())
+                except Exception as e:
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    def _environ(scope, body, size):
+        server = scope.get("server") or ("localhost", 80)
+        remote = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": remote[0],
+            "CONTENT_LENGTH": str(size),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in scope.get("headers", []):
+            name = name.decode("latin-1").lower()
+            value = value.decode("latin-1")
+            if name == "content-type":
+                environ["CONTENT_TYPE"] = value
+            elif name != "content-length":
+                key = "HTTP_" + name.upper().replace("-", "_")
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    async def _dispatch(self, environ):
+        ctx = self.app.request_context(environ)
+        ctx.push()
+        try:
+            try:
+                rv = self.app.preprocess_request()
+                if rv is None:
+                    rv = await self._call_view()
+            except Exception as e:
+                rv = self.app.handle_user_exception(e)
+            return self.app.finalize_request(rv)
+        except Exception as e:
+            return self.app.handle_exception(e)
+        finally:
+            ctx.pop()
+
+    async def _call_view(self):
+        req = request._get_current_object()
+        if req.routing_exception is not None:
+            self.app.raise_routing_exception(req)
+        rule = req.url_rule
+        if getattr(rule, "provide_automatic_options", False) and req.method == "OPTIONS":
+            return self.app.make_default_options_response()
+        view = self.app.view_functions[rule.endpoint]
+        if inspect.iscoroutinefunction(view):
+            return await view(**req.view_args)
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(None, context.run, partial(view, **req.view_args))
+
+    @staticmethod
+    async def _send_response(environ, response, send):
+        app_iter, status, headers = response.get_wsgi_response(environ)
+        await send({
+            "type": "http.response.start",
+            "status": int(status.split(" ", 1)[0]),
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+        })
+        try:
+            if response.is_sequence:
+                await send({"type": "http.response.body", "body": b"".join(app_iter)})
+                return
+            # Arquivos (send_from_directory) são lidos no executor, em blocos
+            loop = asyncio.get_running_loop()
+            iterator = iter(app_iter)
+            while True:
+                chunk = await loop.run_in_executor(None, next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+
+asgi_app = FlaskASGI(app)
+
+def serve_asgi(host, port, **options):
+    # Roda o uvicorn no próprio loop do Telethon: as views aguardam as chamadas
+    # ao Telegram diretamente, sem uma thread por requisição
+    import uvicorn
+
+    lifecycle.start()
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host=host, port=port, lifespan="on", **options))
+    future = asyncio.run_coroutine_threadsafe(server.serve(), asyncio_loop)
+    try:
+        future.result()
+    except KeyboardInterrupt:
+        server.should_exit = True
+        future.result()
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=443, ssl_context=("/etc/letsencrypt/live/paineltech.shop/fullchain.pem", "/etc/letsencrypt/live/paineltech.shop/privkey.pem"))
+    ssl_files = ("/etc/letsencrypt/live/paineltech.shop/fullchain.pem", "/etc/letsencrypt/live/paineltech.shop/privkey.pem")
+    if os.environ.get("SERVER_MODE", "wsgi") == "asgi":
+        serve_asgi("0.0.0.0", 443, ssl_certfile=ssl_files[0], ssl_keyfile=ssl_files[1])
+    else:
+        create_app().run(host="0.0.0.0", port=443, ssl_context=ssl_files)
@@ -0,0 +1,367 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+from io import BytesIO
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+
+from telethon import TelegramClient, utils
+from telethon.errors import FloodWaitError
+from telethon.sessions import StringSession
+from telethon.tl.functions.channels import GetFullChannelRequest, GetParticipantsRequest
+from telethon.tl.functions.messages import GetDialogsRequest, SendMessageRequest, SendMediaRequest
+from telethon.tl.types import (
+    Channel, ChatPhotoEmpty, User, InputPeerEmpty, InputPeerUser, InputMediaEmpty, ChannelParticipantsSearch
+)
+
+PARTICIPANTS_PAGE = 200
+SMALL_GROUP_MEMBERS = 50
+INVITE_LINK_SAMPLE = 50  # grupos consultados no cenário de links de convite
+api = None  # importado em main(), depois de entrar no diretório de trabalho
+backend = None
+
+
+def sample_png():
+    # PNG válido gerado com o Pillow: o pré-processamento das imagens roda de verdade
+    from PIL import Image
+
+    buffer = BytesIO()
+    Image.new("RGB", (640, 480), (40, 120, 200)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+# Backend falso do Telegram
+class FakeBackend:
+    # Estado compartilhado pelas contas falsas: grupos, membros, latência por
+    # RPC e injeção de FloodWait nos envios
+    def __init__(self, groups, members, latency, flood_rate, flood_seconds):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.big_members = members
+        self.entities = [
+            Channel(id=1000 + i, title=f"Grupo {i}", photo=ChatPhotoEmpty(), date=None, megagroup=True, access_hash=i)
+            for i in range(groups)
+        ]
+        self._members = {}
+        self.rpc_count = 0
+        self.floods = 0
+        self.sends = []  # [(timestamp, peer_id)]
+        self._message_id = 0
+
+    def members(self, chat_id):
+        users = self._members.get(chat_id)
+        if users is None:
+            # O primeiro grupo é o grande; os demais têm poucos membros
+            total = self.big_members if chat_id == self.entities[0].id else SMALL_GROUP_MEMBERS
+            users = self._members[chat_id] = [
+                User(id=10_000_000 + n, access_hash=n, first_name=f"Membro {n}", username=f"membro{n}" if n % 3 else None)
+                for n in range(total)
+            ]
+        return users
+
+    async def handle(self, request):
+        self.rpc_count += 1
+        await asyncio.sleep(self.latency)
+        if isinstance(request, (SendMessageRequest, SendMediaRequest)):
+            if self.flood_rate and random.random() < self.flood_rate:
+                self.floods += 1
+                raise FloodWaitError(request=request, capture=self.flood_seconds)
+            self._message_id += 1
+            self.sends.append((time.time(), utils.get_peer_id(request.peer)))
+            media = getattr(request, "media", None)
+            return SimpleNamespace(id=self._message_id, media=SimpleNamespace(uploaded=media))
+        if isinstance(request, GetFullChannelRequest):
+            link = f"https://t.me/+convite{request.channel.id}"
+            return SimpleNamespace(full_chat=SimpleNamespace(exported_invite=SimpleNamespace(link=link)))
+        if isinstance(request, GetParticipantsRequest):
+            users = self.members(request.channel.id)
+            return users[request.offset:request.offset + request.limit]
+        return None
+
+
+class FakeRpc(TelegramClient):
+    # Fica abaixo de InstrumentedTelegramClient na MRO: limitador, métricas e
+    # traces da API rodam de verdade e só a rede é substituída
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        return await self.backend.handle(request)
+
+
+class FakeTelegramClient:
+    # Métodos de alto nível usados pela API, cada um passando por _call
+    async def connect(self):
+        return None
+
+    async def disconnect(self):
+        return None
+
+    def is_connected(self):
+        return True
+
+    async def is_user_authorized(self):
+        return True
+
+    async def get_me(self, input_peer=False):
+        return InputPeerUser(1, 0)
+
+    async def get_dialogs(self, limit=None):
+        dialogs = []
+        for start in range(0, len(self.backend.entities), 100):
+            await self._call(None, GetDialogsRequest(
+                offset_date=None, offset_id=0, offset_peer=InputPeerEmpty(), limit=100, hash=0
+            ))
+            for entity in self.backend.entities[start:start + 100]:
+                dialogs.append(SimpleNamespace(
+                    id=utils.get_peer_id(entity), name=entity.title, title=entity.title,
+                    entity=entity, is_group=True, is_channel=True
+                ))
+        return dialogs
+
+    async def get_participants(self, chat):
+        users = []
+        while True:
+            page = await self._call(None, GetParticipantsRequest(
+                channel=chat, filter=ChannelParticipantsSearch(""), offset=len(users), limit=PARTICIPANTS_PAGE, hash=0
+            ))
+            users.extend(page)
+            if len(page) < PARTICIPANTS_PAGE:
+                return users
+
+    async def send_file(self, chat, file, caption="", **kwargs):
+        media = file if isinstance(file, SimpleNamespace) else InputMediaEmpty()
+        return await self._call(None, SendMediaRequest(peer=chat, media=media, message=caption))
+
+    async def send_message(self, chat, text, formatting_entities=None, **kwargs):
+        return await self._call(None, SendMessageRequest(peer=chat, message=text, entities=formatting_entities))
+
+
+def fake_client_class():
+    return type("BenchTelegramClient", (FakeTelegramClient, api.InstrumentedTelegramClient, FakeRpc), {})
+
+
+# Medições
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+def latency_summary(latencies, elapsed, operations):
+    return {
+        "operations": operations,
+        "elapsed_seconds": elapsed,
+        "throughput_per_second": operations / elapsed if elapsed else None,
+        "p50_ms": percentile(latencies, 0.50) * 1000 if latencies else None,
+        "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None,
+    }
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        return None
+
+class Measure:
+    # Tempo total, tempo de banco e memória de um cenário
+    def __init__(self, results, name):
+        self.results = results
+        self.name = name
+        self.data = {}
+
+    def __enter__(self):
+        self.db_before = api.db_time.totals()
+        self.rpc_before = backend.rpc_count
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        db_count, db_seconds = api.db_time.totals()
+        self.data.update({
+            "wall_seconds": time.perf_counter() - self.start,
+            "db_seconds": db_seconds - self.db_before[1],
+            "db_connections": db_count - self.db_before[0],
+            "rpc_calls": backend.rpc_count - self.rpc_before,
+            "rss_mb": rss_mb(),
+        })
+        self.results[self.name] = self.data
+        print(f"{self.name}: {json.dumps(self.data, default=str)}")
+
+def run(coro):
+    return asyncio.run_coroutine_threadsafe(coro, api.asyncio_loop).result()
+
+
+# Cenários
+def bench_groups(results, http, accounts):
+    with Measure(results, "load_groups") as m:
+        for account in accounts:
+            run(api.load_groups(account))
+        m.data["groups"] = len(api.group_store.all())
+
+    with Measure(results, "get_groups") as m:
+        latencies = []
+        start = time.perf_counter()
+        offset = 0
+        while offset is not None:
+            t0 = time.perf_counter()
+            response = http.get(f"/groups?offset={offset}&limit=100").get_json()
+            latencies.append(time.perf_counter() - t0)
+            offset = response["next_offset"]
+        m.data.update(latency_summary(latencies, time.perf_counter() - start, len(latencies)))
+
+    # Links de convite sob demanda: a primeira leitura faz o GetFull*, a
+    # segunda vem da memória
+    chat_ids = [group["id"] for group in api.group_store.all()[:INVITE_LINK_SAMPLE]]
+    for name in ("invite_links_cold", "invite_links_warm"):
+        with Measure(results, name) as m:
+            latencies = []
+            start = time.perf_counter()
+            for chat_id in chat_ids:
+                t0 = time.perf_counter()
+                http.get(f"/groups/{chat_id}/invite_link")
+                latencies.append(time.perf_counter() - t0)
+            m.data.update(latency_summary(latencies, time.perf_counter() - start, len(latencies)))
+
+def bench_add_tasks(results, http, args):
+    image = http.post("/images", data={"images": (BytesIO(sample_png()), "bench.png")},
+                      content_type="multipart/form-data").get_json()["uploaded_images"][0]["path"]
+    # Longe do horário atual para que nada dispare durante o cenário
+    fire_time = (datetime.now() + timedelta(hours=12)).strftime("%H:%M")
+    groups = [entity.title for entity in backend.entities]
+    task_ids = []
+    with Measure(results, "add_tasks") as m:
+        latencies = []
+        start = time.perf_counter()
+        for offset in range(0, args.tasks, args.batch):
+            batch = [
+                {"group_name": groups[n % len(groups)], "time": fire_time, "text": f"Tarefa {n}", "image_path": image}
+                for n in range(offset, min(args.tasks, offset + args.batch))
+            ]
+            t0 = time.perf_counter()
+            response = http.post("/add_tasks", json={"tasks": batch}).get_json()
+            latencies.append(time.perf_counter() - t0)
+            task_ids.extend(task["task_id"] for task in response["tasks"])
+        m.data.update(latency_summary(latencies, time.perf_counter() - start, len(latencies)))
+        m.data["tasks_per_second"] = len(task_ids) / m.data["elapsed_seconds"]
+    return task_ids
+
+def bench_tag_members(results, http, args):
+    group = backend.entities[0].title
+    for name in ("tag_members_cold", "tag_members_warm"):
+        repeat = 1 if name.endswith("cold") else args.repeat
+        with Measure(results, name) as m:
+            latencies = []
+            start = time.perf_counter()
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                response = http.get(f"/tag_members/{group}").get_json()
+                latencies.append(time.perf_counter() - t0)
+            m.data.update(latency_summary(latencies, time.perf_counter() - start, repeat))
+            m.data["members"] = sum(len(chunk["mentions"]) for chunk in response["chunks"])
+            m.data["chunks"] = len(response["chunks"])
+
+def bench_scheduler(results, task_ids, args):
+    sends_before = len(backend.sends)
+    floods_before = backend.floods
+    with Measure(results, "scheduler_fire") as m:
+        due = time.time()
+        for task_id in task_ids:
+            api.scheduler._push(task_id, due)
+        deadline = time.time() + args.timeout
+        while len(backend.sends) - sends_before < len(task_ids) and time.time() < deadline:
+            time.sleep(0.05)
+        sends = backend.sends[sends_before:]
+        elapsed = (max(ts for ts, _ in sends) - due) if sends else None
+        m.data.update(latency_summary([ts - due for ts, _ in sends], elapsed, len(sends)))
+        m.data["expected_sends"] = len(task_ids)
+        m.data["flood_waits"] = backend.floods - floods_before
+        scheduler = api.scheduler.metrics()
+        m.data["scheduler_lag_p50_seconds"] = scheduler["lag_p50_seconds"]
+        m.data["scheduler_lag_p99_seconds"] = scheduler["lag_p99_seconds"]
+
+
+def main():
+    global api, backend
+    parser = argparse.ArgumentParser(description="Benchmark offline da API com um Telegram falso")
+    parser.add_argument("--tasks", type=int, default=10_000)
+    parser.add_argument("--groups", type=int, default=1_000)
+    parser.add_argument("--members", type=int, default=50_000, help="membros do grupo usado em /tag_members")
+    parser.add_argument("--accounts", type=int, default=2)
+    parser.add_argument("--batch", type=int, default=500, help="tarefas por requisição em /add_tasks")
+    parser.add_argument("--repeat", type=int, default=20, help="repetições de /tag_members com cache quente")
+    parser.add_argument("--latency", type=float, default=0.002, help="latência de cada RPC falsa, em segundos")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="probabilidade de FloodWait em cada envio")
+    parser.add_argument("--flood-seconds", type=int, default=1)
+    parser.add_argument("--rpc-rate", type=float, default=1000,
+                        help="teto do limitador por conta (use o valor de produção para medir o ritmo real)")
+    parser.add_argument("--chat-rate", type=float, default=1000, help="teto do limitador por chat")
+    parser.add_argument("--group-load-rate", type=float, default=1000, help="GetFull* por segundo nas buscas de link de convite")
+    parser.add_argument("--timeout", type=float, default=600, help="espera máxima pelos envios do agendador")
+    parser.add_argument("--output", help="arquivo JSON de resultados (padrão: bench-results/bench-<data>.json)")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output or os.path.join(
+        "bench-results", f"bench-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    ))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # data.db e uploads/ são relativos ao diretório atual: o bench usa um temporário
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.chdir(workdir)
+    os.environ["EXECUTION_MODE"] = "inline"
+    os.environ.pop("TRACE_FILE", None)
+    import_start = time.perf_counter()
+    import api as api_module
+    api = api_module
+    import_seconds = time.perf_counter() - import_start
+
+    api.RPC_GLOBAL_RATE = args.rpc_rate
+    api.CHAT_SEND_RATE = args.chat_rate
+    api.CHAT_SEND_BURST = max(api.CHAT_SEND_BURST, int(args.chat_rate))
+    api.GROUP_LOAD_RATE = args.group_load_rate
+    backend = FakeBackend(args.groups, args.members, args.latency, args.flood_rate, args.flood_seconds)
+    client_class = fake_client_class()
+    api.create_client = lambda session, api_id, api_hash: client_class(session, int(api_id), api_hash)
+    startup_start = time.perf_counter()
+    app = api.create_app()
+    api.lifecycle.wait("caches")
+    startup_seconds = time.perf_counter() - startup_start
+    accounts = []
+    for n in range(args.accounts):
+        tg_client = api.create_client(StringSession(), 1, "bench")
+        tg_client.backend = backend
+        account = api.Account(f"+5500000000{n:02d}", tg_client)
+        account.health = "ok"
+        api.session_pool.add(account)
+        accounts.append(account)
+    api.authenticated = True
+    http = app.test_client()
+
+    results = {}
+    bench_groups(results, http, accounts)
+    task_ids = bench_add_tasks(results, http, args)
+    bench_tag_members(results, http, args)
+    bench_scheduler(results, task_ids, args)
+
+    report = {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "config": vars(args),
+        "import_seconds": import_seconds,
+        "startup_seconds": startup_seconds,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "scenarios": results,
+    }
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Resultados salvos em {output}")
+
+
+if __name__ == "__main__":
+    main()
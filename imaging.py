@@ -0,0 +1,56 @@
+import os
+from PIL import Image, ImageOps
+
+# Pré-processamento das imagens, executado nos processos do pool de api.py.
+# O módulo não tem estado nem efeitos na importação, e só depende do Pillow.
+PHOTO_MAX_SIDE = 2560  # o Telegram reduz fotos maiores que isso de qualquer forma
+PHOTO_QUALITY = 85
+THUMB_MAX_SIDE = 320
+THUMB_QUALITY = 70
+EXIF_ORIENTATION = 0x0112
+
+
+def flatten(image):
+    # JPEG não tem transparência: o fundo transparente vira branco
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        rgba = image.convert("RGBA")
+        background = Image.new("RGB", rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        return background
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+
+def save_jpeg(image, path, quality):
+    # Grava em um temporário e renomeia: quem lê nunca vê o arquivo pela metade
+    temp_path = f"{path}.{os.getpid()}.part"
+    image.save(temp_path, "JPEG", quality=quality, optimize=True, progressive=True)
+    os.replace(temp_path, path)
+
+
+def prepare_variants(source, photo_path, thumb_path):
+    # Gera a miniatura do painel e a foto para o Telegram (orientação corrigida,
+    # no máximo PHOTO_MAX_SIDE e recomprimida). A foto só é mantida se o
+    # original precisava de ajuste ou se ela ficou menor; GIFs animados seguem
+    # como estão.
+    with Image.open(source) as original:
+        animated = getattr(original, "is_animated", False)
+        rotated = original.getexif().get(EXIF_ORIENTATION, 1) != 1
+        image = flatten(ImageOps.exif_transpose(original))
+    width, height = image.size
+
+    photo = False
+    if not animated:
+        resized = max(width, height) > PHOTO_MAX_SIDE
+        scaled = image
+        if resized:
+            scaled = image.copy()
+            scaled.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE), Image.LANCZOS)
+        save_jpeg(scaled, photo_path, PHOTO_QUALITY)
+        photo = rotated or resized or os.path.getsize(photo_path) < os.path.getsize(source)
+        if not photo:
+            os.remove(photo_path)
+
+    thumb = image.copy()
+    thumb.thumbnail((THUMB_MAX_SIDE, THUMB_MAX_SIDE), Image.LANCZOS)
+    save_jpeg(thumb, thumb_path, THUMB_QUALITY)
+    return {"width": width, "height": height, "photo": photo}
@@ -0,0 +1,61 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class TaskQueryTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # data.db é relativo ao diretório atual
+        cls.previous_cwd = os.getcwd()
+        cls.workdir = tempfile.TemporaryDirectory()
+        os.chdir(cls.workdir.name)
+        import api
+        cls.api = api
+        api.init_db()
+        api.task_repo.load()
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.previous_cwd)
+        cls.workdir.cleanup()
+
+    def setUp(self):
+        repo = self.api.task_repo
+        repo.delete_many([task_id for task_id, _ in repo.all()])
+        base = {"group_name": "g", "text": "", "image": "", "status": "Rodando", "tag_members": False, "kind": "single"}
+        repo.add_many([
+            ("daily-0930", dict(base, time="09:30", next_fire_at=3000.0)),
+            ("cron-0900", dict(base, time="0 9 * * *", next_fire_at=2000.0)),
+            ("daily-2300", dict(base, time="23:00", next_fire_at=5000.0)),
+            ("stopped", dict(base, time="08:00", status="Parada", next_fire_at=None)),
+        ])
+
+    def ids(self, **filters):
+        return [task_id for task_id, _ in self.api.task_repo.query(**filters)[1]]
+
+    def test_time_range_only_matches_daily_tasks(self):
+        # Como texto, "0 9 * * *" < "10:00": antes entrava em qualquer faixa
+        self.assertEqual(self.ids(time_to="10:00"), ["daily-0930", "stopped"])
+        self.assertEqual(self.ids(time_from="09:00", time_to="10:00"), ["daily-0930"])
+
+    def test_fire_range_includes_cron_tasks(self):
+        self.assertEqual(self.ids(fire_from=1500.0, fire_to=3500.0), ["cron-0900", "daily-0930"])
+
+    def test_ordered_by_next_fire(self):
+        self.assertEqual(self.ids(), ["cron-0900", "daily-0930", "daily-2300", "stopped"])
+
+    def test_schedule_is_normalised_for_the_time_filter(self):
+        self.assertEqual(self.api.validate_schedule("9:05"), "09:05")
+        self.assertEqual(self.api.validate_schedule("0 9 * * *"), "0 9 * * *")
+
+    def test_schedule_that_never_fires_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.api.validate_schedule("0 0 31 2 *")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import time
+import socket
+import asyncio
+import argparse
+
+import api
+
+HEARTBEAT_INTERVAL = api.JOB_LEASE_SECONDS / 3
+POLL_INTERVAL = 1.0
+PURGE_INTERVAL = 3600
+
+
+async def heartbeat(job, owner):
+    # Renova o lease enquanto o envio está em andamento
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        await asyncio.to_thread(api.job_queue.extend, job, owner)
+
+
+async def run_job(job, owner, semaphore):
+    try:
+        task = await asyncio.to_thread(api.task_repo.fetch, job["task_id"])
+        if not task or task.get("status") != "Rodando":
+            # Tarefa removida ou parada depois do enfileiramento
+            await asyncio.to_thread(api.job_queue.complete, job, owner)
+            return
+        beat = asyncio.ensure_future(heartbeat(job, owner))
+        try:
+            await api.execute_task(job["task_id"], task)
+        finally:
+            beat.cancel()
+        await asyncio.to_thread(api.job_queue.complete, job, owner)
+    except Exception as e:
+        status = await asyncio.to_thread(api.job_queue.fail, job, owner, str(e))
+        print(f"Job {job['id']} ({job['task_id']}) falhou na tentativa {job['attempts']}: {e} -> {status}")
+    finally:
+        semaphore.release()
+
+
+async def work(owner, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    last_purge = 0
+    while True:
+        await semaphore.acquire()
+        try:
+            job = await asyncio.to_thread(api.job_queue.claim, owner)
+        except Exception as e:
+            print(f"Erro ao buscar job: {e}")
+            job = None
+        if job is None:
+            semaphore.release()
+            if time.time() - last_purge > PURGE_INTERVAL:
+                last_purge = time.time()
+                await asyncio.to_thread(api.job_queue.purge)
+            await asyncio.sleep(POLL_INTERVAL)
+            continue
+        asyncio.ensure_future(run_job(job, owner, semaphore))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker de envio das tarefas agendadas")
+    parser.add_argument("--concurrency", type=int, default=api.BROADCAST_CONCURRENCY)
+    args = parser.parse_args()
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    # O worker não agenda tarefas: só consome a fila de jobs gravada pela API,
+    # e começa a consumir quando as contas já estão conectadas
+    api.lifecycle.start(schedule=False)
+    api.lifecycle.wait("accounts")
+    print(f"Worker {owner} iniciado com {len(api.session_pool)} conta(s)")
+    # Executa no mesmo loop em que as contas do Telethon foram conectadas
+    asyncio.run_coroutine_threadsafe(work(owner, args.concurrency), api.asyncio_loop).result()
+
+
+if __name__ == "__main__":
+    main()